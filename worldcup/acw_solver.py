@@ -0,0 +1,132 @@
+# coding: utf-8
+"""acw_sc__v2 challenge 求解
+
+challenge 页面中的混淆脚本包含
+    var arg1='<40 位 hex>';                      arg1
+    var _0x4818=['...', ...];                    加密的字符串数组
+    (function(a, b){...}(_0x4818, 0x15b));       字符串数组的循环移位
+    var _0x55f3=function(a, b){var a=parseInt(a, 0x10); ...}
+    _0x55f3('0x3', 'jS1Y')                       解密函数调用 第二个参数为 RC4 key
+    [0xf, 0x23, ...]                             40 个数的 shuffle 数组
+cookie 为 RC4 解密后的字符串数组第 3 项与按 shuffle 重排的 arg1 的 xor
+"""
+
+import base64
+import codecs
+import re
+from typing import Dict, List
+
+_IDENT = r'[a-zA-Z0-9_$]+'
+_INT = r'(?:0x[0-9a-fA-F]+|[0-9]+)'
+
+_LITERAL = r'(?:\'[^\']*\'|"[^"]*"|' + _INT + r')'
+
+SCRIPT_PATTERN = re.compile(r'<script[^>]*>(.*?)</script>', re.DOTALL)
+STRING_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"")
+SHUFFLES_PATTERN = re.compile(r'\[\s*(?:' + _INT + r'\s*,\s*){39}' + _INT + r'\s*\]')
+
+# 一次扫描取出全部所需的片段 数组只匹配字面量 以免吞掉其中的解密函数调用
+TOKEN_PATTERN = re.compile(
+    r'var\s+arg1\s*=\s*[\'"](?P<arg1>[^\'"]+)[\'"]'
+    r'|var\s+(?P<func>' + _IDENT + r')\s*=\s*function\s*\(\s*(?P<param>' + _IDENT + r')\s*,\s*' + _IDENT +
+    r'\s*\)\s*\{\s*var\s+(?P=param)\s*=\s*parseInt\s*\(\s*(?P=param)\s*,\s*(?:0x10|16)\s*\)\s*;'
+    r'|var\s+(?P<array>' + _IDENT + r')\s*=\s*(?P<elements>\[\s*(?:' + _LITERAL + r'\s*,\s*)*' + _LITERAL + r'?\s*\])\s*;'
+    r'|\}\s*\(\s*(?P<shifted>' + _IDENT + r')\s*,\s*(?P<shifts>' + _INT + r')\s*\)\s*\)\s*;'
+    r'|(?<![a-zA-Z0-9_$])(?P<caller>' + _IDENT + r')\(\s*[\'"](?P<index>[^\'"]+)[\'"]\s*,\s*[\'"](?P<key>[^\'"]+)[\'"]\)'
+    r'|(?P<shuffles>' + SHUFFLES_PATTERN.pattern + r')'
+)
+
+
+def parse_js_string(s: str) -> bytes:
+    return codecs.escape_decode(s.strip("'\"").encode('utf-8'))[0]
+
+
+def rc4(data: bytes, key: bytes) -> bytes:
+    """先生成 keystream 再整体 xor
+
+    S 盒用 list 实测其下标访问比 bytearray 快
+    """
+    s = list(range(256))
+    j = 0
+    for i, k in enumerate((key * (256 // len(key) + 1))[:256]):
+        si = s[i]
+        j = (j + si + k) & 0xff
+        s[i] = s[j]
+        s[j] = si
+
+    length = len(data)
+    keystream = bytearray(length)
+    i = j = 0
+    for n in range(length):
+        i = (i + 1) & 0xff
+        si = s[i]
+        j = (j + si) & 0xff
+        sj = s[j]
+        s[i] = sj
+        s[j] = si
+        keystream[n] = s[(si + sj) & 0xff]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(length, 'big')
+
+
+def unbox(s: str, shuffles: List[int]) -> str:
+    return ''.join(s[v - 1] for v in shuffles if v - 1 < len(s))
+
+
+def hexor(hex1: str, hex2: str) -> str:
+    return bytes(a ^ b for a, b in zip(bytes.fromhex(hex1), bytes.fromhex(hex2))).hex()
+
+
+def solve(html_content: str) -> str:
+    """求解 challenge 页面 返回 acw_sc__v2 cookie 的值 页面格式不符时 raise ValueError"""
+    code = '\n'.join(SCRIPT_PATTERN.findall(html_content))
+
+    arg1 = shifted = shifts = func = shuffles = None
+    arrays: Dict[str, str] = {}
+    calls: Dict[str, list] = {}
+    for match in TOKEN_PATTERN.finditer(code):
+        kind = match.lastgroup
+        if kind == 'arg1':
+            if arg1 is None:
+                arg1 = match.group('arg1')
+        elif kind == 'elements':
+            elements = match.group('elements')
+            arrays.setdefault(match.group('array'), elements)
+            if shuffles is None and SHUFFLES_PATTERN.fullmatch(elements):
+                shuffles = elements
+        elif kind == 'shifts':
+            if shifted is None:
+                shifted, shifts = match.group('shifted'), int(match.group('shifts'), 0)
+        elif kind == 'key':
+            calls.setdefault(match.group('caller'), []).append((match.group('index'), match.group('key')))
+        elif kind == 'shuffles':
+            if shuffles is None:
+                shuffles = match.group('shuffles')
+        elif kind == 'param':
+            if func is None:
+                func = match.group('func')
+
+    if arg1 is None:
+        raise ValueError('arg1 not found')
+    if shifted is None:
+        raise ValueError('iife array shift match not found')
+    if shifted not in arrays:
+        raise ValueError(f'Array {shifted} not found')
+    # 移位后只用到第 3 项 不必解码整个数组
+    ciphers = STRING_PATTERN.findall(arrays[shifted][1:-1])
+    cipher = parse_js_string(ciphers[(3 + shifts) % len(ciphers)])
+    if func is None:
+        raise ValueError('decryption function match not found')
+    keys = {int(index, 0): key for index, key in calls.get(func, [])}
+    if shuffles is None:
+        raise ValueError('shuffles array not found')
+
+    # 脚本按 charCodeAt 做 RC4 key 取低 8 位即可
+    # 密文字符若不小于 256 解密结果必然不是 hex 因此按 latin-1 编码失败即无法求解
+    try:
+        decrypted_key = rc4(
+            base64.b64decode(cipher).decode('utf-8').encode('latin-1'),
+            bytes(ord(c) & 0xff for c in parse_js_string(keys[3]).decode('utf-8')),
+        ).decode('ascii')
+    except UnicodeError as e:
+        raise ValueError(f'decrypted key is not hex: {e}')
+    return hexor(decrypted_key, unbox(arg1, [int(x.strip(), 0) for x in shuffles.strip('[]').split(',')]))
@@ -2,19 +2,21 @@
 
 import datetime
 import functools
+import json
 import requests
+import time
 from urllib.parse import urlencode
 
-from flask import Flask, session, render_template, request, redirect, url_for, g, abort
+from flask import Flask, session, render_template, request, redirect, url_for, g, abort, jsonify, stream_with_context, flash
 from pymongo import MongoClient
 from werkzeug.local import LocalProxy
 
-from . import config
+from . import config, metrics, querystats
 
 app = Flask(__name__)
 app.config.from_object(config)
 
-dbclient = app.dbclient = MongoClient(app.config['MONGO_URI'])
+dbclient = app.dbclient = MongoClient(app.config['MONGO_URI'], event_listeners=[querystats.QueryListener()])
 logindb = app.logindb = dbclient[app.config['MONGO_LOGINDB']]
 
 
@@ -46,6 +48,12 @@ def _ts(time: datetime.datetime) -> int:
     return time.replace(tzinfo=datetime.timezone.utc).timestamp() - 8 * 3600
 
 
+@app.template_filter('gambler_name')
+def gambler_name(gambler_id: int) -> str:
+    """数据库中以 id 引用 gambler 渲染时再取名字"""
+    return model.find_gambler_name(gambler_id)
+
+
 def next_url():
     return request.args.get('next') or request.referrer or url_for('index')
 
@@ -76,12 +84,43 @@ def authenticated(f):
     return _
 
 
+@app.before_request
+def start_request_stats():
+    # 先于其他 before_request 注册 统计请求内的全部数据库命令及耗时
+    g.request_started = time.perf_counter()
+    g.query_stats = querystats.QueryStats()
+
+
+@app.after_request
+def record_request_stats(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+        metrics.registry.flush()
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+    response.headers.add('Server-Timing', stats.server_timing())
+    log = app.logger.warning if stats.count > app.config['QUERY_BUDGET'] else app.logger.info
+    log('query_stats %s', json.dumps(
+        dict(method=request.method, path=request.path, status=response.status_code, **stats._asdict()),
+        ensure_ascii=False))
+    return response
+
+
 @app.before_request
 def before_request():
     g.me = model.find_user_by_openid(session.get('openid'))
     g.tournament = get_tournament(session.get('dbname'), default=app.config['DEFAULT_TOURNAMENT'])
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_export():
+    return app.response_class(metrics.render(metrics.registry.collect()), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/auth/complete', methods=['GET'])
 def auth_complete():
     if g.me:
@@ -143,23 +182,64 @@ def dbswitch(dbname):
     return redirect(next_url())
 
 
+BET_REJECTED = '已过投注时间或比赛不存在'
+
+
 @app.route('/', methods=['GET', 'POST'])
 @authenticated
 def index():
+    status = 200
     if request.method == 'POST':
         match_id = request.values.get('match-id')
         bet_choice = request.values.get('bet-choice')
-        model.update_match_gamblers(match_id=match_id, team=bet_choice, gambler=g.me)
-
-    matches = model.find_matches(reverse=True, limit=app.config['MAX_MATCH_DISPLAY'])
-    return render_template('index.html', matches=matches)
+        accepted = model.update_match_gamblers(match_id=match_id, team=bet_choice, gambler=g.me)
+        ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        if not accepted:
+            # 已过投注时间或比赛不存在
+            status = 409
+            if ajax:
+                return BET_REJECTED, status
+            flash(BET_REJECTED, 'danger')
+        # ajax 投注只返回该比赛的卡片 滚动加载的比赛不在第一页中
+        elif ajax:
+            match = model.find_match_by_id(match_id)
+            return render_template('_match_cards.html', matches=[match] if match else [])
+
+    matches = model.find_matches(reverse=True, limit=app.config['MAX_MATCH_DISPLAY'], before=request.args.get('before'))
+    return render_template('index.html', matches=matches), status
+
+
+@app.route('/matches', methods=['GET'])
+@authenticated
+def match_cards():
+    """index 页面滚动到底部时加载的更早比赛 只返回比赛卡片"""
+    matches = model.find_matches(reverse=True, limit=app.config['MAX_MATCH_DISPLAY'], before=request.args.get('before'))
+    return render_template('_match_cards.html', matches=matches)
 
 
-@app.route('/board', methods=['GET'])
+@app.route('/events', methods=['GET'])
 @authenticated
-def board():
-    many_series = model.generate_series()
-
+def events():
+    """以 Server-Sent Events 推送比赛投注 / 比分 / 盘口的变化
+
+    连接在 EVENTS_STREAM_TIMEOUT 秒后关闭 由 EventSource 自动重连
+    连接期间一直占用 worker 须使用 gevent 或多线程的 worker class
+    """
+    def stream():
+        for changed in model.watch_matches(app.config['EVENTS_POLL_INTERVAL'], app.config['EVENTS_STREAM_TIMEOUT']):
+            if not changed:
+                # 心跳 及时发现已断开的连接
+                yield ': keepalive\n\n'
+            for event in changed:
+                yield 'event: match\ndata: {}\n\n'.format(json.dumps(event, ensure_ascii=False))
+
+    return app.response_class(
+        stream_with_context(stream()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def board_data(many_series: list) -> dict:
+    """把全部 gambler 的 Series 转换为 Chart.js 的 labels 和 datasets"""
     match_ids = many_series and many_series[0].points.keys() or []
     labels = ['{1} vs {2}'.format(*match_id.split('-')) for match_id in sorted(match_ids)]  # 用 sorted() 确保 match_ids 有序
 
@@ -179,8 +259,36 @@ def board():
     data = dict()
     data['labels'] = labels
     data['datasets'] = datasets
+    return data
 
-    return render_template('board.html', label_count=len(labels), data=data)
+
+@app.route('/board', methods=['GET'])
+@authenticated
+def board():
+    return render_template('board.html')
+
+
+@app.route('/api/board', methods=['GET'])
+@authenticated
+def api_board():
+    # 积分榜未改写时 ETag 不变 直接返回 304 不读取积分榜
+    etag = '{}-{}'.format(g.tournament.dbname, model.find_version('standings'))
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(board_data(model.find_standings()))
+    response.set_etag(etag)
+    # 浏览器每次都需携带 If-None-Match 重新验证
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/board/all', methods=['GET'])
+@authenticated
+def board_all():
+    standings = model.generate_all_time_standings()
+    return render_template('board_all.html', standings=standings)
 
 
 @app.route('/rule', methods=['GET'])
@@ -0,0 +1,206 @@
+# coding: utf-8
+"""性能基准 在独立的数据库中生成模拟 tournament 并计时热点路径
+
+结果以 JSON 输出 便于比较不同 commit 的结果
+
+    $ flask bench --gamblers 100 --matches 640 > bench.json
+    $ flask bench --solver --repeat 100 > bench_solver.json
+"""
+
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import time
+from typing import Callable, Dict, List, Tuple
+
+from flask import g
+
+from . import acw_solver, model
+from .app import app, dbclient, logindb
+from .config import Tournament
+from .constant import HANDICAP_DICT
+
+BENCH_TOURNAMENT = Tournament(dbname='bench', league='基准', display='基准', weight_schedule=[])
+# 模拟 gambler 写入共用的 login 数据库 以不会与真实用户重名的前缀命名
+BENCH_GAMBLER_PREFIX = '__bench-g'
+
+# 模拟的 acw_sc__v2 challenge 页面 expected.json 中为各页面的 cookie
+ACW_CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'testdata', 'acw_sc_v2')
+
+# 按让球数升序排列的盘口名称
+_HANDICAP_NAMES = sorted((k for k, v in HANDICAP_DICT.items() if not isinstance(v, str)), key=HANDICAP_DICT.get)
+
+
+def _random_handicap_display(rng: random.Random) -> str:
+    """随机生成 '受半球/一球' 形式的盘口"""
+    i = rng.randrange(6)
+    display = _HANDICAP_NAMES[i]
+    if rng.random() < 0.5:
+        display += '/' + _HANDICAP_NAMES[i + 1]
+    if display != '平手' and rng.random() < 0.5:
+        display = '受' + display
+    return display
+
+
+def _bench_gambler_name(i: int) -> str:
+    return f'{BENCH_GAMBLER_PREFIX}{i:03d}'
+
+
+def generate_tournament(n_gamblers: int, n_matches: int, n_teams=32, bet_rate=0.9, scored_rate=0.9, seed=0):
+    """在当前 tournament 数据库中生成模拟数据 返回 gambler 名单
+
+    前 scored_rate 的比赛已有比分 每个 gambler 以 bet_rate 的概率投注每场比赛
+    """
+    rng = random.Random(seed)
+    gamblers = [model.Gambler(_bench_gambler_name(i)) for i in range(n_gamblers)]
+    teams = [f'队{i:02d}' for i in range(n_teams)]
+    kickoff = datetime.datetime(2018, 6, 14, 20, 0)
+
+    model.tournamentdb.gambler.insert_many([gambler._asdict() for gambler in gamblers])
+    model.tournamentdb.auction.insert_many([
+        model.Auction(team=team, gambler=rng.choice(gamblers).id, price=rng.randint(1, 50))._asdict()
+        for team in teams
+    ])
+
+    matches = []
+    for i in range(n_matches):
+        team_a, team_b = rng.sample(teams, 2)
+        scored = i < n_matches * scored_rate
+        match = model.Match(
+            BENCH_TOURNAMENT.league, kickoff + datetime.timedelta(hours=3 * i), _random_handicap_display(rng),
+            team_a, team_b, 1.9, 1.9,
+            rng.randint(0, 4) if scored else None, rng.randint(0, 4) if scored else None,
+            weight=rng.choice([2, 2, 2, 4, 8]), owners={})
+        for gambler in gamblers:
+            if rng.random() < bet_rate:
+                (match.a if rng.random() < 0.5 else match.b)['gamblers'].append(gambler.id)
+        matches.append(match._asdict())
+    model.tournamentdb.match.insert_many(matches)
+    model.refresh_standings()
+    return gamblers
+
+
+def _timeit(func: Callable, repeat: int) -> dict:
+    """执行 repeat 次 返回以毫秒为单位的统计结果"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return dict(
+        repeat=repeat,
+        min_ms=round(min(timings), 3),
+        median_ms=round(statistics.median(timings), 3),
+        mean_ms=round(statistics.mean(timings), 3),
+    )
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run(n_gamblers=10, n_matches=64, repeat=5, seed=0) -> dict:
+    """生成模拟 tournament 并计时 结束后删除模拟数据"""
+    app.config['TOURNAMENTS'].append(BENCH_TOURNAMENT)
+    try:
+        with app.app_context():
+            g.tournament = BENCH_TOURNAMENT
+            dbclient.drop_database(BENCH_TOURNAMENT.dbname)
+            model.clear_caches()
+            try:
+                gamblers = generate_tournament(n_gamblers, n_matches, seed=seed)
+                users = [model.insert_user(name=gambler.name, openid=f'bench-openid-{gambler.name}') for gambler in gamblers]
+                results = _run_benchmarks(gamblers, users, repeat, seed)
+            finally:
+                names = [_bench_gambler_name(i) for i in range(n_gamblers)]
+                logindb.user.delete_many({'openid': {'$in': [f'bench-openid-{name}' for name in names]}})
+                # 只删除模拟 gambler 的 id 再以前缀限定 不会误删真实的名册记录
+                ids = [model.find_gambler_id(name, create=False) for name in names]
+                logindb.gambler.delete_many({
+                    '_id': {'$in': [i for i in ids if i is not None]},
+                    'name': {'$regex': f'^{re.escape(BENCH_GAMBLER_PREFIX)}'},
+                })
+                dbclient.drop_database(BENCH_TOURNAMENT.dbname)
+                model.clear_caches()
+    finally:
+        app.config['TOURNAMENTS'].remove(BENCH_TOURNAMENT)
+
+    return dict(
+        revision=_git_revision(),
+        python=platform.python_version(),
+        params=dict(gamblers=n_gamblers, matches=n_matches, repeat=repeat, seed=seed),
+        results=results,
+    )
+
+
+def _run_benchmarks(gamblers: List[model.Gambler], users: List[model.User], repeat: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    matches = model.find_matches()
+    scored = [m for m in matches if m.has_score()] or matches
+    displays = [m.handicap_display for m in matches]
+
+    def bet():
+        # 改投已有比分的比赛 包含积分榜重算
+        model.update_match_gamblers(rng.choice(scored).id, rng.choice('ab'), rng.choice(gamblers), cutoff_check=False)
+
+    def handicap_pairs():
+        for display in displays:
+            model._generate_handicap_pair(display)
+
+    results = dict(
+        find_matches=_timeit(model.find_matches, repeat),
+        generate_series=_timeit(model.generate_series, repeat),
+        find_standings=_timeit(model.find_standings, repeat),
+        update_match_gamblers=_timeit(bet, repeat),
+        generate_handicap_pair=_timeit(handicap_pairs, repeat),
+    )
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = users[0].openid
+        session['dbname'] = BENCH_TOURNAMENT.dbname
+    for path in ('/', '/board', '/api/board', '/rule'):
+        def view():
+            r = client.get(path)
+            assert r.status_code == 200, f'{path}: {r.status_code}'
+        results[f'view {path}'] = _timeit(view, repeat)
+    return results
+
+
+def load_acw_corpus() -> Dict[str, Tuple[str, str]]:
+    """{文件名: (challenge 页面, cookie)}"""
+    with open(os.path.join(ACW_CORPUS_DIR, 'expected.json')) as f:
+        expected = json.load(f)
+    corpus = {}
+    for name, cookie in sorted(expected.items()):
+        with open(os.path.join(ACW_CORPUS_DIR, name)) as f:
+            corpus[name] = (f.read(), cookie)
+    return corpus
+
+
+def run_solver(repeat=100, rc4_bytes=4096) -> dict:
+    """计时 acw_sc__v2 求解 不需要数据库"""
+    pages = [html for html, _ in load_acw_corpus().values()]
+    data = bytes(random.Random(0).randrange(256) for _ in range(rc4_bytes))
+
+    def solve():
+        for html in pages:
+            acw_solver.solve(html)
+
+    return dict(
+        revision=_git_revision(),
+        python=platform.python_version(),
+        params=dict(pages=len(pages), rc4_bytes=rc4_bytes, repeat=repeat),
+        results=dict(
+            solve_corpus=_timeit(solve, repeat),
+            rc4=_timeit(lambda: acw_solver.rc4(data, b'jS1Y'), repeat),
+        ),
+    )
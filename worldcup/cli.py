@@ -1,10 +1,19 @@
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import bson.json_util
 import click
+import pymongo
+from bson import ObjectId
 from flask import g
+from pymongo import ReplaceOne
 
-from worldcup import model
+from worldcup import bench as benchmark, model
 from worldcup.app import app, dbclient, get_tournament
-from worldcup.match_getter import populate_and_update
+from worldcup.match_getter import populate_and_update, run_daemon
 
 
 @app.cli.command('add_auction')
@@ -28,6 +37,156 @@ def update_weight(db, match_id, new_weight):
     print(f'✅ update_weight: {match_id} now with weight as {new_weight}')
 
 
+def _plan_stages(plan: dict) -> list:
+    """展开 explain() winningPlan 中的全部 stage"""
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key in ('queryPlan', 'inputStage'):
+        if key in plan:
+            stages += _plan_stages(plan[key])
+    for p in plan.get('inputStages', []):
+        stages += _plan_stages(p)
+    return stages
+
+
+@app.cli.command('rename_user')
+@click.argument('current')
+@click.argument('new')
+def rename_user(current, new):
+    try:
+        model.update_user_name(current=current, new=new)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f'✅ rename_user: {current} -> {new}')
+
+
+@app.cli.command('migrate_gambler_ids')
+@click.argument('dbs', nargs=-1)
+@click.option('--history', default=None, type=click.Path(exists=True, file_okay=False),
+              help='Also convert the archives under this directory in place.')
+def migrate_gambler_ids(dbs, history):
+    """把以名字引用 gambler 的 tournament 数据改为 gambler id 可重复执行
+
+    指定 --history 时先导入归档中的名册 使数据库与归档使用相同的 id 最后改写归档并写回名册
+    """
+    registry = os.path.join(history, app.config['MONGO_LOGINDB'], 'gambler.json') if history else None
+    if registry and os.path.exists(registry):
+        with open(registry) as f:
+            inserted = model.import_gambler_registry([d for batch in _iter_batches(f, EXPORT_BATCH_SIZE) for d in batch])
+        print(f'✅ migrate_gambler_ids: {inserted} gamblers imported from {registry}')
+
+    for db in [get_tournament(db).dbname for db in dbs] or [t.dbname for t in app.config['TOURNAMENTS']]:
+        counts = model.migrate_gambler_ids(dbclient[db])
+        g.tournament = get_tournament(db)
+        model.refresh_standings()
+        print(f'✅ migrate_gambler_ids: {db} ' + ' '.join(f'{co}={count}' for co, count in counts.items()))
+    for name in model.ensure_indexes():
+        print(f'✅ ensure_indexes: {name}')
+
+    if not history:
+        return
+    # 按 tournament 顺序分配 id 名册所在的 login 数据库除外
+    order = [t.dbname for t in app.config['TOURNAMENTS']]
+    archived = [db for db in os.listdir(history) if db != app.config['MONGO_LOGINDB']]
+    for db in sorted(archived, key=lambda db: (order.index(db) if db in order else len(order), db)):
+        for co in EXPORT_COLLECTIONS:
+            path = os.path.join(history, db, f'{co}.json')
+            if os.path.exists(path):
+                print(f'✅ migrate_gambler_ids: {path} ({_migrate_archive(co, path)} records converted)')
+    os.makedirs(os.path.dirname(registry), exist_ok=True)
+    count = _export(dbclient[app.config['MONGO_LOGINDB']].gambler, registry)
+    print(f'✅ migrate_gambler_ids: {count} gamblers -> {registry}')
+
+
+def _gambler_ids(collection: str, doc: dict) -> bool:
+    """把归档中的一条记录改为以 id 引用 gambler 返回是否有改动"""
+    def to_id(gambler):
+        return model.find_gambler_id(gambler) if isinstance(gambler, str) else gambler
+
+    if collection == 'gambler' and 'name' in doc:
+        # 保持字段顺序
+        items = [(k, v) if k != 'name' else ('id', to_id(v)) for k, v in doc.items()]
+        doc.clear()
+        doc.update(items)
+        return True
+    if collection == 'auction' and isinstance(doc['gambler'], str):
+        doc['gambler'] = to_id(doc['gambler'])
+        return True
+    if collection == 'match' and any(isinstance(x, str) for side in 'ab' for x in doc[side]['gamblers']):
+        for side in 'ab':
+            doc[side]['gamblers'] = [to_id(x) for x in doc[side]['gamblers']]
+        return True
+    return False
+
+
+def _migrate_archive(collection: str, path: str) -> int:
+    """逐行改写归档 其余字段原样保留 返回改写的记录数"""
+    converted = 0
+    tmp = f'{path}.tmp'
+    with open(path, encoding='utf-8') as src, open(tmp, 'w', encoding='utf-8') as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            converted += _gambler_ids(collection, doc)
+            dst.write(json.dumps(doc, ensure_ascii=False, separators=(',', ':')) + '\n')
+    os.replace(tmp, path)
+    return converted
+
+
+@app.cli.command('ensure_indexes')
+@click.option('--explain', default=True, type=bool, help='Report explain() plans for the hot queries.')
+def ensure_indexes(explain):
+    """创建索引 部署或恢复数据后执行一次 app 启动时不再自动创建"""
+    try:
+        created = model.ensure_indexes()
+    except pymongo.errors.OperationFailure as e:
+        raise click.ClickException(str(e))
+    for name in created:
+        print(f'✅ ensure_indexes: {name}')
+    if not explain:
+        return
+    # 每个请求都会执行的查询 (collection, filter, sort) 均不应出现 COLLSCAN
+    logindb = dbclient[app.config['MONGO_LOGINDB']]
+    hot_queries = [
+        (logindb.user, {'openid': ''}, None),
+        (logindb.user, {'name': ''}, None),
+        (logindb.gambler, {'name': ''}, None),
+    ]
+    for t in app.config['TOURNAMENTS']:
+        db = dbclient[t.dbname]
+        hot_queries += [
+            (db.match, {'id': ''}, None),
+            (db.match, {}, [('id', pymongo.DESCENDING)]),
+            (db.match, {'match_time': {'$gte': datetime.datetime.min}}, None),
+            (db.auction, {'team': ''}, None),
+            (db.gambler, {'id': 0}, None),
+            (db.standings, {}, model.STANDINGS_ORDER),
+        ]
+    collscans = 0
+    for ctl, filter, sort in hot_queries:
+        cursor = ctl.find(filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = _plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        collscans += 'COLLSCAN' in stages
+        print(f'{"❌" if "COLLSCAN" in stages else "✅"} explain: {ctl.full_name} filter={filter} sort={sort} '
+              f'plan={" <- ".join(stages)}')
+    if collscans:
+        raise click.ClickException(f'{collscans} hot queries with COLLSCAN')
+
+
+@app.cli.command('all_time_board')
+@click.option('--resettle', default=False, type=bool, help='Settle every tournament again instead of reading standings.')
+@click.option('--parallel', default=True, type=bool, help='Settle tournaments in a process pool when resettling.')
+def all_time_board(resettle, parallel):
+    standings = model.generate_all_time_standings(resettle=resettle, parallel=parallel)
+    dbnames = [t.dbname for t in app.config['TOURNAMENTS']]
+    print('\t'.join(['#', 'gambler', 'total'] + dbnames))
+    for i, s in enumerate(standings, 1):
+        points = ['{:.2f}'.format(s.points[d]) if d in s.points else '-' for d in dbnames]
+        print('\t'.join([str(i), s.gambler, '{:.2f}'.format(s.total)] + points))
+
+
 @app.cli.command('fetch_match')
 @click.argument('db')
 @click.option('--days', default=1, type=int, help='Fetch incoming matches in days.')
@@ -37,16 +196,195 @@ def fetch_match(db, days, dry_run):
     populate_and_update(g.tournament.league, g.tournament.weight_schedule, k=days, dry_run=dry_run)
 
 
+@app.cli.command('fetch_daemon')
+@click.argument('db')
+@click.option('--days', default=1, type=int, help='Fetch incoming matches in days.')
+def fetch_daemon(db, days):
+    """常驻抓取 盘口截止前及比赛进行中频繁轮询 其他时间低频轮询"""
+    g.tournament = get_tournament(db)
+    run_daemon(g.tournament.league, g.tournament.weight_schedule, k=days)
+
+
+# 按 key upsert 导入时各 collection 的唯一 key
+IMPORT_KEYS = {
+    'match': 'id',
+    'auction': 'team',
+    'gambler': 'id',
+    'standings': 'id',
+    'user': 'openid',
+}
+
+
+def _iter_batches(lines, batch_size):
+    """逐行解析 mongoexport 导出的文件 每 batch_size 条返回一次"""
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(bson.json_util.loads(line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 @app.cli.command('import_collection')
 @click.argument('db')
 @click.argument('collection')
 @click.argument('json', type=click.Path(exists=True, dir_okay=False, resolve_path=True))
 @click.option('--drop', default=True, type=bool, help='Drop existing collection before import.')
-def import_collection(db, collection, json, drop):
-    with open(json) as f:
-        data = [bson.json_util.loads(l) for l in f]
+@click.option('--upsert', default=False, type=bool, help='Upsert by key (implies --drop false).')
+@click.option('--batch-size', default=1000, type=click.IntRange(min=1), help='Records per unordered batch.')
+def import_collection(db, collection, json, drop, upsert, batch_size):
+    if db == app.config['MONGO_LOGINDB'] and collection == 'gambler':
+        # 名册只增不改 已有的 id 保持不变
+        with open(json) as f:
+            inserted = model.import_gambler_registry([d for batch in _iter_batches(f, batch_size) for d in batch])
+        print(f'✅ import_collection: {db}.gambler ({inserted} inserted)')
+        return
     ctl = dbclient[db][collection]
-    if drop:
+    key = IMPORT_KEYS.get(collection)
+    if upsert and not key:
+        raise click.ClickException(f'no upsert key for collection: {collection}')
+    if drop and not upsert:
         ctl.drop()
-    ctl.insert_many(data)
-    print(f'✅ import_collection: {ctl.full_name} ({ctl.find().count()} records)')
+
+    # 逐批写入 内存占用与文件大小无关
+    started = time.monotonic()
+    total = inserted = modified = skipped = 0
+    with open(json) as f:
+        for batch in _iter_batches(f, batch_size):
+            if upsert:
+                requests = []
+                for i, d in enumerate(batch, total + 1):
+                    if key not in d:
+                        print(f'❌ import_collection: record #{i} has no {key}, skipped: {d}')
+                        skipped += 1
+                        continue
+                    # 不保留导出的 _id 已存在的记录 _id 不可修改
+                    requests.append(ReplaceOne({key: d[key]}, {k: v for k, v in d.items() if k != '_id'}, upsert=True))
+                if requests:
+                    r = ctl.bulk_write(requests, ordered=False)
+                    inserted += r.upserted_count
+                    modified += r.modified_count
+            else:
+                inserted += len(ctl.insert_many(batch, ordered=False).inserted_ids)
+            total += len(batch)
+    elapsed = time.monotonic() - started
+    print(f'{"❌" if skipped else "✅"} import_collection: {ctl.full_name} ({total} records, {inserted} inserted, '
+          f'{modified} modified, {skipped} skipped, {total / elapsed if elapsed else 0:.0f} records/s)')
+    # drop 会一并删除索引 导入后重建
+    try:
+        for name in model.ensure_indexes(db, collection):
+            print(f'✅ ensure_indexes: {name}')
+    except pymongo.errors.OperationFailure as e:
+        raise click.ClickException(str(e))
+    # 导入 tournament 数据后重建积分榜
+    if collection in ('match', 'auction', 'gambler') and db in [t.dbname for t in app.config['TOURNAMENTS']]:
+        g.tournament = get_tournament(db)
+        if collection == 'match':
+            model.bump_version('match')
+        model.refresh_standings()
+        print(f'✅ import_collection: {db}.standings rebuilt')
+    if skipped:
+        raise click.ClickException(f'{skipped} records skipped without {key}')
+
+
+# 归档的 collection
+EXPORT_COLLECTIONS = ('match', 'auction', 'gambler')
+EXPORT_BATCH_SIZE = 5000
+
+
+def _extended_json(value):
+    """转换为 mongoexport 的 extended JSON 格式 $date 精确到毫秒"""
+    if isinstance(value, dict):
+        return {k: _extended_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_extended_json(v) for v in value]
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.strftime('%Y-%m-%dT%H:%M:%S.') + f'{value.microsecond // 1000:03d}Z'}
+    return value
+
+
+def export_line(doc: dict) -> str:
+    """与 history/*.json 相同的单行格式"""
+    return json.dumps(_extended_json(doc), ensure_ascii=False, separators=(',', ':'))
+
+
+def _export(ctl, path) -> int:
+    """按 _id 顺序把 collection 写入 path 返回记录数 先写临时文件再替换 避免留下不完整的归档"""
+    count = 0
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        for doc in ctl.find().sort('_id', pymongo.ASCENDING).batch_size(EXPORT_BATCH_SIZE):
+            f.write(export_line(doc) + '\n')
+            count += 1
+    os.replace(tmp, path)
+    return count
+
+
+@app.cli.command('export_collection')
+@click.argument('db')
+@click.argument('collection')
+@click.argument('json', type=click.Path(dir_okay=False, resolve_path=True))
+def export_collection(db, collection, json):
+    ctl = dbclient[db][collection]
+    count = _export(ctl, json)
+    print(f'✅ export_collection: {ctl.full_name} ({count} records) -> {json}')
+
+
+@app.cli.command('export_tournament')
+@click.argument('dbs', nargs=-1)
+@click.option('--out', default='history', type=click.Path(file_okay=False), help='Archive root directory.')
+@click.option('--workers', default=4, type=click.IntRange(min=1), help='Collections exported concurrently.')
+def export_tournament(dbs, out, workers):
+    """归档指定 tournament 未指定时归档全部 tournament"""
+    dbs = [get_tournament(db).dbname for db in dbs] or [t.dbname for t in app.config['TOURNAMENTS']]
+    # 归档中以 id 引用 gambler 名册一并归档
+    logindb = app.config['MONGO_LOGINDB']
+    os.makedirs(os.path.join(out, logindb), exist_ok=True)
+    jobs = [(dbclient[logindb].gambler, os.path.join(out, logindb, 'gambler.json'))]
+    for db in dbs:
+        os.makedirs(os.path.join(out, db), exist_ok=True)
+        jobs += [(dbclient[db][co], os.path.join(out, db, f'{co}.json')) for co in EXPORT_COLLECTIONS]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(lambda job: _export(*job), jobs))
+    for (ctl, path), count in zip(jobs, counts):
+        print(f'✅ export_tournament: {ctl.full_name} ({count} records) -> {path}')
+
+
+@app.cli.command('bench')
+@click.option('--gamblers', default=10, type=click.IntRange(min=1), help='Number of synthetic gamblers.')
+@click.option('--matches', default=64, type=click.IntRange(min=1), help='Number of synthetic matches.')
+@click.option('--repeat', default=5, type=click.IntRange(min=1), help='Runs per benchmark.')
+@click.option('--seed', default=0, type=int, help='Random seed of the synthetic tournament.')
+@click.option('--solver', is_flag=True, help='Benchmark the acw_sc__v2 solver on the saved challenge pages instead.')
+def bench(gamblers, matches, repeat, seed, solver):
+    """在独立数据库中生成模拟 tournament 并以 JSON 输出各热点路径耗时"""
+    if solver:
+        result = benchmark.run_solver(repeat=repeat)
+    else:
+        result = benchmark.run(n_gamblers=gamblers, n_matches=matches, repeat=repeat, seed=seed)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+@app.cli.command('rebuild_standings')
+@click.argument('db')
+@click.option('--check', default=True, type=bool, help='Check rebuilt standings against generate_series().')
+def rebuild_standings(db, check):
+    g.tournament = get_tournament(db)
+    model.refresh_standings()
+    print(f'✅ rebuild_standings: {db}.standings rebuilt')
+    if not check:
+        return
+    expected = {s.gambler: s.points for s in model.generate_series() if s.points}
+    actual = {s.gambler: s.points for s in model.find_standings()}
+    if actual != expected:
+        for gambler in sorted(set(expected) | set(actual)):
+            if expected.get(gambler) != actual.get(gambler):
+                print(f'❌ rebuild_standings: {gambler} mismatched')
+        raise click.ClickException('standings mismatched with generate_series()')
+    print(f'✅ rebuild_standings: {len(actual)} gamblers checked against generate_series()')
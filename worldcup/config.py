@@ -13,9 +13,31 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'super secret key')
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
 MONGO_LOGINDB = os.getenv('MONGO_LOGINDB', 'logins')
 
+# 多进程部署时各进程写入 metrics 的共享目录 为空时只导出本进程的数据
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+
+# 单个请求的数据库命令数超过此值时记录 warning
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', '20'))
+
+# 登录用户缓存 减少 before_request 中的数据库查询
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '60'))
+
+# /events 推送 无 change streams 时的轮询间隔（兼作心跳间隔）及单次连接的最长时间
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '2'))
+EVENTS_STREAM_TIMEOUT = float(os.getenv('EVENTS_STREAM_TIMEOUT', '300'))
+
 WECHAT_APPID = os.getenv('WECHAT_APPID', '')
 WECHAT_APPSECRET = os.getenv('WECHAT_APPSECRET', '')
 
+# fetch_match 请求的连接 / 读取超时 秒 上游无响应时该次请求失败 而不是一直阻塞
+FETCH_TIMEOUT = (float(os.getenv('FETCH_CONNECT_TIMEOUT', '5')), float(os.getenv('FETCH_READ_TIMEOUT', '30')))
+
+# acw_sc__v2 cookie 缓存文件 fetch_match 各次运行间共享 为空时不缓存
+# 应位于只有本 app 可写的目录中 不要放在共享的系统临时目录
+ACW_COOKIE_CACHE = os.getenv('ACW_COOKIE_CACHE', '')
+
 # weight schedule 应为 北京时间 比赛日+1
 TOURNAMENTS = [
     Tournament(
@@ -1,16 +1,27 @@
 import time
 import datetime
+import json
 import logging
+import os
 import requests
+import tempfile
+import threading
 
 import re
-import base64
-import codecs
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from flask import g
+from pymongo import UpdateOne
 from requests import Response, PreparedRequest
 from requests.adapters import HTTPAdapter
 
-from worldcup import constant
-from worldcup.model import insert_match, update_match_score, update_match_handicap, utc_to_beijing, find_match_by_id, _generate_match_id
+from worldcup import acw_solver, config, constant, metrics
+from worldcup.model import (
+    Match, utc_to_beijing, find_match_by_id, find_matches, find_matches_by_ids, bulk_write_matches,
+    _generate_match_id, _generate_handicap_pair, _parse_score, MATCH_SETTLEMENT_FIELDS,
+)
 
 
 HEADERS = {
@@ -23,87 +34,76 @@ HEADERS = {
 class AcwScV2Adapter(HTTPAdapter):
     COOKIE_KEY = "acw_sc__v2"
     COOKIE_VALUE = None
-
-    def _parse_js_string(self, s: str) -> bytes:
-        return codecs.escape_decode(s.strip("'\"").encode("utf-8"))[0]
-
-    def _rc4_str(self, data: str, key: str) -> str:
-        s = list(range(256))
-        j = 0
-        for i in range(256):
-            j = (j + s[i] + ord(key[i % len(key)])) % 256
-            s[i], s[j] = s[j], s[i]
-
-        i = j = 0
-        output = []
-        for char in data:
-            i = (i + 1) % 256
-            j = (j + s[i]) % 256
-            s[i], s[j] = s[j], s[i]
-            output.append(chr(ord(char) ^ s[(s[i] + s[j]) % 256]))
-        return "".join(output)
-
-    def _unbox(self, s: str, shuffles: list) -> str:
-        return "".join(s[v - 1] for v in shuffles if v - 1 < len(s))
-
-    def _hexor(self, hex1: str, hex2: str) -> str:
-        return bytes(a ^ b for a, b in zip(bytes.fromhex(hex1), bytes.fromhex(hex2))).hex()
-
-    def _solve(self, html_content: str) -> str:
-        code = "\n".join(re.findall(r"<script[^>]*>(.*?)</script>", html_content, re.DOTALL))
-
-        arg1_match = re.search(r'var\s+arg1\s*=\s*[\'"]([^\'"]+)[\'"]', code)
-        if not arg1_match:
-            raise ValueError("arg1 not found")
-        arg1 = arg1_match.group(1)
-
-        iife_match = re.search(
-            r"\}\s*\(\s*([a-zA-Z0-9_$]+)\s*,\s*(0x[0-9a-fA-F]+|[0-9]+)\s*\)\s*\)\s*;",
-            code,
+    COOKIE_SOLVED_AT = None     # cookie 求解时间 unix timestamp
+    COOKIE_LIFETIME = None      # 上次观察到的 cookie 有效时长 秒
+
+    _cookie_lock = threading.Lock()
+
+    def __init__(self, *args, cookie_cache=None, **kwargs):
+        super(AcwScV2Adapter, self).__init__(*args, **kwargs)
+        self.cookie_cache = cookie_cache
+        if cookie_cache and AcwScV2Adapter.COOKIE_VALUE is None:
+            self._load_cookie()
+
+    def _load_cookie(self) -> None:
+        """从缓存文件读取 cookie 已超过观察到的有效时长则只保留有效时长"""
+        try:
+            with open(self.cookie_cache) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        AcwScV2Adapter.COOKIE_LIFETIME = cached.get("lifetime")
+        lifetime = AcwScV2Adapter.COOKIE_LIFETIME
+        if lifetime is not None and time.time() - cached["solved_at"] >= lifetime:
+            logging.info(f"{self.COOKIE_KEY} cache expired: solved_at={cached['solved_at']} lifetime={lifetime}")
+            return
+        AcwScV2Adapter.COOKIE_VALUE = cached["value"]
+        AcwScV2Adapter.COOKIE_SOLVED_AT = cached["solved_at"]
+        logging.info(f"{self.COOKIE_KEY} loaded from cache: solved_at={cached['solved_at']} lifetime={lifetime}")
+
+    def _save_cookie(self) -> None:
+        """写入缓存文件 先写临时文件再替换 避免读到不完整的内容"""
+        if not self.cookie_cache:
+            return
+        cached = dict(
+            value=AcwScV2Adapter.COOKIE_VALUE,
+            solved_at=AcwScV2Adapter.COOKIE_SOLVED_AT,
+            lifetime=AcwScV2Adapter.COOKIE_LIFETIME,
         )
-        if not iife_match:
-            raise ValueError("iife array shift match not found")
-        array_name = iife_match.group(1)
-        num_shifts = int(iife_match.group(2), 0)
-
-        array_pattern = r"var\s+" + re.escape(array_name) + r"\s*=\s*\[(.*?)\]\s*;"
-        array_match = re.search(array_pattern, code)
-        if not array_match:
-            raise ValueError(f"Array {array_name} not found")
-
-        ciphers = [self._parse_js_string(el) for el in re.findall(r"'[^']*'|\"[^\"]*\"", array_match.group(1))]
-
-        if num_shifts:
-            num_shifts %= len(ciphers)
-            ciphers = ciphers[num_shifts:] + ciphers[:num_shifts]
-
-        func_match = re.search(
-            r"var\s+([a-zA-Z0-9_$]+)\s*=\s*function\s*\(\s*([a-zA-Z0-9_$]+)\s*,\s*[a-zA-Z0-9_$]+\s*\)\s*\{\s*var\s+\2\s*=\s*parseInt\s*\(\s*\2\s*,\s*(0x10|16)\s*\)\s*;",
-            code,
-        )
-        if not func_match:
-            raise ValueError("decryption function match not found")
-        func_name = func_match.group(1)
-
-        keys = {}
-        key_pattern = re.escape(func_name) + r'\(\s*[\'"]([^\'"]+)[\'"]\s*,\s*[\'"]([^\'"]+)[\'"]\)'
-        for match in re.finditer(key_pattern, code):
-            keys[int(match.group(1), 0)] = self._parse_js_string(match.group(2))
-
-        decrypted_key = self._rc4_str(
-            base64.b64decode(ciphers[3]).decode("utf-8"),
-            keys[3].decode("utf-8"),
-        )
-
-        shuffles_match = re.search(
-            r"\[\s*(?:(?:0x[0-9a-fA-F]+|[0-9]+)\s*,\s*){39}(?:0x[0-9a-fA-F]+|[0-9]+)\s*\]",
-            code,
-        )
-        if not shuffles_match:
-            raise ValueError("shuffles array not found")
-        shuffles = [int(x.strip(), 0) for x in shuffles_match.group(0).strip("[]").split(",")]
+        try:
+            # mkstemp 以 O_EXCL 创建名字随机的文件 不会跟随他人预先放置的 symlink
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cookie_cache)), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(cached, f)
+                os.replace(tmp, self.cookie_cache)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            logging.warning(f"{self.COOKIE_KEY} cache not saved: {e}")
+
+    def _refresh_cookie(self, html_content: str, sent: str) -> str:
+        """服务端再次下发 challenge 时重新求解 并记录上一个 cookie 的有效时长
+
+        并发请求同时被 challenge 时只求解一次 其余请求直接使用新的 cookie
+        """
+        with self._cookie_lock:
+            if AcwScV2Adapter.COOKIE_VALUE is not None and AcwScV2Adapter.COOKIE_VALUE != sent:
+                return AcwScV2Adapter.COOKIE_VALUE
+            with metrics.FETCH_STAGE_SECONDS.time(stage='solve'):
+                value = self._solve(html_content)
+            now = time.time()
+            if AcwScV2Adapter.COOKIE_SOLVED_AT is not None:
+                AcwScV2Adapter.COOKIE_LIFETIME = now - AcwScV2Adapter.COOKIE_SOLVED_AT
+            AcwScV2Adapter.COOKIE_VALUE = value
+            AcwScV2Adapter.COOKIE_SOLVED_AT = now
+            self._save_cookie()
+        logging.info(f"{self.COOKIE_KEY} solved: lifetime={AcwScV2Adapter.COOKIE_LIFETIME}")
+        return value
 
-        return self._hexor(decrypted_key, self._unbox(arg1, shuffles))
+    def _solve(self, html_content: str) -> str:
+        return acw_solver.solve(html_content)
 
     def _update_cookie_header(self, request: PreparedRequest, value: str) -> None:
         cookie_header = request.headers.get("Cookie", "")
@@ -118,13 +118,13 @@ class AcwScV2Adapter(HTTPAdapter):
         request.headers["Cookie"] = cookie_header
 
     def send(self, request: PreparedRequest, **kwargs) -> Response:
-        if AcwScV2Adapter.COOKIE_VALUE is not None:
-            self._update_cookie_header(request, AcwScV2Adapter.COOKIE_VALUE)
+        sent = AcwScV2Adapter.COOKIE_VALUE
+        if sent is not None:
+            self._update_cookie_header(request, sent)
 
         response = super(AcwScV2Adapter, self).send(request, **kwargs)
         if "var arg1=" in response.text and self.COOKIE_KEY in response.text:
-            AcwScV2Adapter.COOKIE_VALUE = self._solve(response.text)
-            self._update_cookie_header(request, AcwScV2Adapter.COOKIE_VALUE)
+            self._update_cookie_header(request, self._refresh_cookie(response.text, sent))
             return super(AcwScV2Adapter, self).send(request, **kwargs)
         return response
 
@@ -143,15 +143,66 @@ def retry(func):
     return _
 
 
+# 并发下载的线程数 同时也是连接池大小
+FETCH_WORKERS = 4
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """返回进程内共享的 session 复用连接池及 acw_sc__v2 cookie"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            session.mount("https://", AcwScV2Adapter(
+                pool_connections=1, pool_maxsize=FETCH_WORKERS, cookie_cache=config.ACW_COOKIE_CACHE))
+            _session = session
+    return _session
+
+
+def _timed(name, func):
+    """记录每个请求的耗时"""
+    def _(*args, **kwargs):
+        start = time.perf_counter()
+        r = func(*args, **kwargs)
+        logging.info(f'Fetched: name={name} status={r.status_code} elapsed={(time.perf_counter() - start) * 1000:.0f}ms')
+        return r
+    return _
+
+
 def get_match_data(league, current_date):
     url_odds = f"https://www.macauslot.com/soccer/json/realtime/threeinone_odds_sc_fb.json?nocache={int(time.time() * 1000)}"
     url_event = "https://www.macauslot.com/infoApi/cn/D/FB/matchs/list"
 
-    session = requests.Session()
-    session.headers.update(HEADERS)
-    session.mount("https://", AcwScV2Adapter())
-
-    r = retry(session.get)(url_odds)
+    session = get_session()
+
+    # 盘口及各日期的赛事列表互不依赖 并发下载
+    start = time.perf_counter()
+    with metrics.FETCH_STAGE_SECONDS.time(stage='download'), ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        timeout = config.FETCH_TIMEOUT
+        f_odds = executor.submit(retry(_timed('odds', session.get)), url_odds, timeout=timeout)
+        f_events = [
+            # 昨天
+            executor.submit(retry(_timed('yesterday', session.post)), url_event, timeout=timeout,
+                            json=dict(date=str((current_date - datetime.timedelta(days=1)).date()))),
+            # 今天
+            executor.submit(retry(_timed('today', session.post)), url_event, timeout=timeout,
+                            json=dict(date=str(current_date.date()))),
+            # from now
+            executor.submit(retry(_timed('from-now', session.post)), url_event, timeout=timeout),
+        ]
+        responses = [f.result() for f in [f_odds] + f_events]
+    logging.info(f'Fetched: name=all elapsed={(time.perf_counter() - start) * 1000:.0f}ms')
+
+    with metrics.FETCH_STAGE_SECONDS.time(stage='parse'):
+        return _parse_match_data(league, responses)
+
+
+def _parse_match_data(league, responses):
+    r = responses[0]
     odds = dict()
     for od in r.json()["data"]:
         market = [m for m in od["markets"] if m["name"] == "让球盘"][0]
@@ -160,19 +211,15 @@ def get_match_data(league, current_date):
     events = []
 
     # 昨天
-    date = str((current_date - datetime.timedelta(days=1)).date())
-    r = retry(session.post)(url_event, json=dict(date=date))
+    r = responses[1]
     try: events += r.json()["data"]["list"]
     except Exception: print(r.content, r.request.headers)
 
     # 今天
-    date = str(current_date.date())
-    r = retry(session.post)(url_event, json=dict(date=date))
-    events += r.json()["data"]["list"]
+    events += responses[2].json()["data"]["list"]
 
     # from now
-    r = retry(session.post)(url_event)
-    events += r.json()["data"]["list"]
+    events += responses[3].json()["data"]["list"]
 
     seen = set()
     matches = []
@@ -229,13 +276,17 @@ def _handicap_display(handicap_in_num):
     return "/".join(handicaps)
 
 
-def populate_and_update(league, weight_schedule, k=1, current_date=None, dry_run=False):
+# 一次抓取写入的变化 new 为新比赛 id handicaps / scores 为 (id, 原值, 新值)
+Changeset = namedtuple('Changeset', ['new', 'handicaps', 'scores'])
+
+
+def populate_and_update(league, weight_schedule, k=1, current_date=None, dry_run=False) -> Optional[Changeset]:
     """Populate and update matches in the given league.
 
     :param league: league filter
     :param k: get match data within k days
     :param current_date: the date from which getter starts
-    :return:
+    :return: changeset written, None when dry_run
     """
     current_date = current_date or utc_to_beijing(datetime.datetime.utcnow())
     date = current_date + datetime.timedelta(days=k)
@@ -246,6 +297,7 @@ def populate_and_update(league, weight_schedule, k=1, current_date=None, dry_run
     matches = get_match_data(league, current_date=current_date)
     print(f'matches fetched: date="{date}" league={league} count={len(matches)} dry_run={dry_run}')
 
+    fetched = []
     for (
         league,
         match_time,
@@ -267,18 +319,99 @@ def populate_and_update(league, weight_schedule, k=1, current_date=None, dry_run
                 weight = w
                 break
         print(league, match_time, handicap_display, team_a, team_b, score_a, score_b, weight)
-        if dry_run: continue
-        match = insert_match(
-            league=league,
-            match_time=match_time,
-            handicap_display=handicap_display,
-            team_a=team_a,
-            team_b=team_b,
-            premium_a=premium_a,
-            premium_b=premium_b,
-            score_a=score_a,
-            score_b=score_b,
-            weight=weight,
-        )
-        update_match_handicap(match_id=match.id, handicap_display=handicap_display)
-        update_match_score(match_id=match.id, score_a=score_a, score_b=score_b)
+        fetched.append(Match(
+            league, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b, weight,
+            owners={},  # owner 不写入数据库 无需查询
+        ))
+    if dry_run:
+        return
+
+    # 一次查询取得已存在的比赛 在内存中比较后只写入有变化的字段
+    existing = find_matches_by_ids([m.id for m in fetched])
+    changeset = Changeset(new=[], handicaps=[], scores=[])
+    requests = []
+    since = None    # 比分有变化的最早比赛时间 从此处起重算积分榜
+    for match in fetched:
+        stored = existing.get(match.id)
+        if not stored:
+            # 新比赛 $setOnInsert 保证并发插入时不覆盖已存在记录
+            requests.append(UpdateOne({'id': match.id}, {'$setOnInsert': match._asdict()}, upsert=True))
+            changeset.new.append(match.id)
+            if match.has_score():
+                since = min(since or match.match_time, match.match_time)
+            continue
+        update = {}
+        # 盘口截止前才更新盘口
+        if stored.can_update_handicap() and match.handicap_display != stored.handicap_display:
+            update['handicap'] = _generate_handicap_pair(match.handicap_display)
+            update['handicap_display'] = match.handicap_display
+            changeset.handicaps.append((match.id, stored.handicap_display, match.handicap_display))
+        score = _parse_score(match.a['score'], match.b['score'])
+        stored_score = (stored.a['score'], stored.b['score'])
+        if score and score != stored_score:
+            update['a.score'], update['b.score'] = score
+            changeset.scores.append((match.id, stored_score, score))
+            since = min(since or stored.match_time, stored.match_time)
+        if update:
+            requests.append(UpdateOne({'id': match.id}, {'$set': update}))
+    print(f'changeset: new={len(changeset.new)} handicaps={len(changeset.handicaps)} scores={len(changeset.scores)}')
+    for match_id, old, new in changeset.handicaps + changeset.scores:
+        logging.info(f'Changed: match={match_id} {old} -> {new}')
+    with metrics.FETCH_STAGE_SECONDS.time(stage='write'):
+        bulk_write_matches(requests, since=since)
+    return changeset
+
+
+# fetch_daemon 的轮询间隔 秒
+POLL_BUSY = 15          # 盘口截止前 HANDICAP_WINDOW 内
+POLL_LIVE = 60          # 开赛后至比分出现
+POLL_IDLE = 1800        # 其他时间
+POLL_RETRY = 60         # 读取比赛失败 无法计算间隔时
+HANDICAP_WINDOW = datetime.timedelta(minutes=15)
+SCORE_WINDOW = datetime.timedelta(hours=6)     # 开赛后超过此时间仍无比分则不再频繁轮询
+
+
+def next_poll_delay(matches: List[Match], now: datetime.datetime) -> float:
+    """根据已知比赛计算距下次轮询的秒数 now 为北京时间
+
+    盘口截止前 HANDICAP_WINDOW 内及开赛后至比分出现前频繁轮询 其余时间等到下一个需要频繁轮询的时刻 至多 POLL_IDLE
+    """
+    delay = POLL_IDLE
+    for m in matches:
+        cutoff = m.handicap_cutoff_time
+        if now < cutoff - HANDICAP_WINDOW:
+            delay = min(delay, (cutoff - HANDICAP_WINDOW - now).total_seconds())
+        elif now < cutoff:
+            delay = min(delay, POLL_BUSY)
+        if now < m.match_time:
+            delay = min(delay, (m.match_time - now).total_seconds())
+        elif not m.has_score() and now < m.match_time + SCORE_WINDOW:
+            delay = min(delay, POLL_LIVE)
+    return max(delay, 1)
+
+
+def run_daemon(league, weight_schedule, k=1, max_polls=None, sleep=time.sleep):
+    """常驻进程 按 next_poll_delay() 的间隔反复执行 populate_and_update()
+
+    HTTP session 及 acw_sc__v2 cookie 在进程内复用 单次抓取或读取数据库失败不会退出
+    """
+    polls = 0
+    while True:
+        # auction 可能在两次轮询之间变化 不沿用 team owner 缓存
+        g.pop('team_owners', None)
+        try:
+            populate_and_update(league, weight_schedule, k=k)
+        except Exception as e:
+            logging.exception(f'fetch_daemon poll failed: {e}')
+        metrics.registry.flush(force=True)
+        polls += 1
+        if max_polls is not None and polls >= max_polls:
+            return
+        now = utc_to_beijing(datetime.datetime.utcnow())
+        try:
+            delay = next_poll_delay(find_matches(projection=MATCH_SETTLEMENT_FIELDS), now)
+        except Exception as e:
+            logging.exception(f'fetch_daemon next poll delay failed: {e}')
+            delay = POLL_RETRY
+        logging.info(f'fetch_daemon: next poll in {delay:.0f}s')
+        sleep(delay)
@@ -0,0 +1,276 @@
+# coding: utf-8
+"""进程内的 counter / histogram 以 Prometheus text format 导出
+
+设置 METRICS_DIR 时为多进程模式 各进程把自己的数据写入 METRICS_DIR/metrics-<pid>.json
+/metrics 合并目录下全部文件 因此多个 gunicorn worker 及 fetch_match 进程的数据都能被导出
+已退出进程的文件被合并入 METRICS_DIR/retired.json 后删除 目录中的文件数不随进程数增长
+"""
+
+import atexit
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# 以秒为单位的 histogram 默认 buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = registry.lock
+        registry.register(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Expect labels of {self.name} to be: {self.labelnames}, but got: {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _snapshot(self) -> dict:
+        return dict(type=self.type, help=self.documentation, labelnames=list(self.labelnames),
+                    samples=[[list(key), value] for key, value in self._values.items()])
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            return super(Counter, self)._snapshot()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [各 bucket 的计数（非累计）..., +Inf 的计数, sum]
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """记录 with 块的耗时 也可用作函数的 decorator"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            snapshot = super(Histogram, self)._snapshot()
+            snapshot['samples'] = [[key, list(value)] for key, value in snapshot['samples']]
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+class Registry:
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._metrics = {}
+        self._flushed_at = 0.0
+        # 最近一次写入文件的进程 fork 后的子进程与之不同
+        self._pid = None
+
+    def register(self, metric: _Metric):
+        self._metrics[metric.name] = metric
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {name: metric._snapshot() for name, metric in self._metrics.items()}
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """多个进程合并文件时互斥"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _retire(self, paths: List[str]):
+        """把已退出进程的文件合并入 retired.json 后删除 需持有 _locked()"""
+        retired = os.path.join(self.directory, 'retired.json')
+        _dump(merge([s for s in map(_load, [retired] + paths) if s]), retired)
+        for path in paths:
+            os.remove(path)
+
+    def flush(self, force=False):
+        """多进程模式下把本进程的数据写入文件 距上次写入不足 flush_interval 秒时跳过"""
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = now
+        path = self._path(os.getpid())
+        try:
+            if self._pid != os.getpid():
+                # 本进程第一次写入 已有的同名文件属于 pid 相同的已退出进程 先合并以免被覆盖
+                self._pid = os.getpid()
+                if os.path.exists(path):
+                    with self._locked():
+                        self._retire([path])
+            os.makedirs(self.directory, exist_ok=True)
+            _dump(self.snapshot(), path)
+        except OSError as e:
+            logging.warning(f'metrics not flushed: {e}')
+
+    def close(self):
+        """进程退出前写入最后的数据并合并入 retired.json"""
+        if not self.directory:
+            return
+        self.flush(force=True)
+        try:
+            with self._locked():
+                if os.path.exists(self._path(os.getpid())):
+                    self._retire([self._path(os.getpid())])
+        except OSError as e:
+            logging.warning(f'metrics not retired: {e}')
+
+    def collect(self) -> Dict[str, dict]:
+        """合并全部进程的数据 单进程模式下即本进程的数据"""
+        if not self.directory:
+            return self.snapshot()
+        self.flush(force=True)
+        with self._locked():
+            paths = sorted(glob.glob(self._path('*')))
+            dead = [path for path in paths if not _alive(path)]
+            if dead:
+                # 被 kill 等未能执行 close() 的进程
+                self._retire(dead)
+            paths = [os.path.join(self.directory, 'retired.json')] + [path for path in paths if path not in dead]
+            # 其他进程正在写入的文件读取失败时跳过
+            return merge([s for s in map(_load, paths) if s])
+
+
+def _load(path: str) -> Optional[Dict[str, dict]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _dump(snapshot: Dict[str, dict], path: str):
+    """先写入临时文件再替换 读取方不会读到写了一半的文件"""
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def _alive(path: str) -> bool:
+    """metrics-<pid>.json 的进程是否仍在运行"""
+    try:
+        pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+    except ValueError:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 其他用户的进程
+        return True
+    return True
+
+
+def merge(snapshots: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """按 label 累加多个进程的数据"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for key, value in metric['samples']:
+                key = tuple(key)
+                if key not in target['samples']:
+                    target['samples'][key] = value
+                elif isinstance(value, list):
+                    target['samples'][key] = [a + b for a, b in zip(target['samples'][key], value)]
+                else:
+                    target['samples'][key] += value
+    for metric in merged.values():
+        metric['samples'] = [[list(key), value] for key, value in metric['samples'].items()]
+    return merged
+
+
+def _format_labels(labelnames, values, **extra) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render(metrics: Dict[str, dict]) -> str:
+    """Prometheus text format 0.0.4"""
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for key, value in sorted(metric['samples']):
+            labelnames = metric['labelnames']
+            if metric['type'] == 'counter':
+                lines.append(f'{name}{_format_labels(labelnames, key)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for le, count in zip(metric['buckets'] + ['+Inf'], value[:-1]):
+                cumulative += count
+                le = le if le == '+Inf' else _format_value(le)
+                lines.append(f'{name}_bucket{_format_labels(labelnames, key, le=le)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labelnames, key)} {_format_value(value[-1])}')
+            lines.append(f'{name}_count{_format_labels(labelnames, key)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry(directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL)
+# 进程退出前写入最后的数据 fetch_match 等 CLI 进程同样会被导出
+atexit.register(registry.close)
+
+REQUEST_SECONDS = Histogram(
+    registry, 'worldcup_request_duration_seconds', 'Request latency by endpoint.',
+    ('endpoint', 'method', 'status'))
+BETS = Counter(
+    registry, 'worldcup_bets_total', 'Bets by result, rejected when the match is missing or outside the bet window.',
+    ('result',))
+SETTLEMENT_SECONDS = Histogram(
+    registry, 'worldcup_settlement_duration_seconds', 'Settlement time by function.',
+    ('function',))
+FETCH_STAGE_SECONDS = Histogram(
+    registry, 'worldcup_fetch_stage_duration_seconds', 'fetch_match stage durations.',
+    ('stage',), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
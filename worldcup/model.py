@@ -1,14 +1,32 @@
 # coding: utf-8
 
+import contextlib
 import datetime
+import importlib
 import logging
+import multiprocessing
+import os
 import pymongo
+import queue
+import threading
+import time
 
 from collections import namedtuple, OrderedDict, UserString
-from typing import List, Literal, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Literal, Optional, Union
 
-from .app import logindb, tournamentdb, dbclient
-from .config import TOURNAMENTS
+from flask import g
+
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.collection import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+from . import metrics, settlement
+from .app import app, logindb, tournamentdb, dbclient
+from .cache import TTLCache
+from .config import TOURNAMENTS, USER_CACHE_SIZE, USER_CACHE_TTL, Tournament
 from .constant import HANDICAP_DICT
 
 
@@ -16,6 +34,151 @@ def utc_to_beijing(utc_time: datetime.datetime) -> datetime.datetime:
     return utc_time + datetime.timedelta(hours=8)
 
 
+# 索引定义 (collection, keys, unique)
+LOGIN_INDEXES = [
+    ('user', [('openid', pymongo.ASCENDING)], True),
+    ('user', [('name', pymongo.ASCENDING)], False),
+    ('gambler', [('name', pymongo.ASCENDING)], True),
+]
+
+TOURNAMENT_INDEXES = [
+    ('match', [('id', pymongo.ASCENDING)], True),
+    ('match', [('match_time', pymongo.ASCENDING), ('id', pymongo.ASCENDING)], False),
+    ('auction', [('team', pymongo.ASCENDING)], True),
+    ('gambler', [('id', pymongo.ASCENDING)], True),
+    ('standings', [('id', pymongo.ASCENDING)], True),
+    ('standings', [('match_time', pymongo.ASCENDING), ('id', pymongo.ASCENDING)], False),
+]
+
+
+def ensure_indexes(dbname: Optional[str] = None, collection: Optional[str] = None) -> List[str]:
+    """为 login 数据库及全部 tournament 数据库创建索引 返回创建的索引全名
+
+    dbname / collection 不为 None 时只创建该数据库 / collection 的索引
+    create_index 是幂等的 重复调用只会确认索引已存在
+    单个索引失败（如与已有索引冲突）时仍继续创建其余索引 最后 raise OperationFailure
+    """
+    created, failed = [], []
+    targets = [(logindb, LOGIN_INDEXES)] if dbname in (None, logindb.name) else []
+    dbnames = [t.dbname for t in TOURNAMENTS] if dbname is None else [dbname]
+    targets += [(dbclient[name], TOURNAMENT_INDEXES) for name in dbnames if name != logindb.name]
+    for db, indexes in targets:
+        for co, keys, unique in indexes:
+            if collection is not None and co != collection:
+                continue
+            try:
+                name = db[co].create_index(keys, unique=unique)
+            except OperationFailure as e:
+                logging.error(f'Index not created: {db.name}.{co} keys={keys} error={e}')
+                failed.append(f'{db.name}.{co} {keys}: {e}')
+                continue
+            created.append(f'{db.name}.{co}.{name}')
+    if failed:
+        raise OperationFailure(f'{len(failed)} indexes not created ({len(created)} ok): ' + '; '.join(failed))
+    return created
+
+
+# 以 openid 为 key 的登录用户缓存
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# 以 tournament dbname 为 key 的已报名 gambler id 集合 gambler 记录只增不删
+_known_gamblers = {}
+
+# 以 tournament dbname 为 key 的 (match 版本号, {match id: 推送字段}) 进程内的 /events 连接共用
+_match_events = {}
+_match_events_lock = threading.Lock()
+
+# gambler 名册 logindb.gambler 的缓存 {'ids': {name: id}, 'names': {id: name}, 'loaded_at': ...}
+_gambler_registry = {}
+_gambler_registry_lock = threading.Lock()
+
+
+def clear_caches():
+    """清空进程内缓存 数据库被直接修改后使用"""
+    _user_cache.clear()
+    _known_gamblers.clear()
+    _gambler_registry.clear()
+    _match_events.clear()
+
+
+def bump_version(key: Literal['match', 'standings'], db=None) -> int:
+    """collection 每次改写后递增其版本号 db 默认为当前 tournament"""
+    db = tournamentdb if db is None else db
+    d = db.meta.find_one_and_update(
+        {'_id': key}, {'$inc': {'version': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    return d['version']
+
+
+def find_version(key: Literal['match', 'standings']) -> int:
+    """collection 当前版本号 从未写入时为 0"""
+    d = tournamentdb.meta.find_one({'_id': key})
+    return d['version'] if d else 0
+
+
+# gambler 名册 logindb.gambler 全部 tournament 共用
+#     _id = 1         # 分配后不再改变 match / auction / gambler / standings 中均以 id 引用 gambler
+#     name = "gambler's name"
+
+def _load_gambler_registry(force=False) -> dict:
+    """读取整个名册 结果缓存 USER_CACHE_TTL 秒 其他进程改名后至多延迟 USER_CACHE_TTL 秒生效"""
+    with _gambler_registry_lock:
+        if force or not _gambler_registry or time.monotonic() - _gambler_registry['loaded_at'] >= USER_CACHE_TTL:
+            names = {d['_id']: d['name'] for d in logindb.gambler.find()}
+            # 整体替换 读取中的 dict 不会被修改
+            _gambler_registry.update(
+                ids={name: gambler_id for gambler_id, name in names.items()}, names=names, loaded_at=time.monotonic())
+        return _gambler_registry
+
+
+def _next_gambler_id() -> int:
+    d = logindb.meta.find_one_and_update(
+        {'_id': 'gambler_id'}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    return d['seq']
+
+
+def find_gambler_id(name: str, create=True) -> Optional[int]:
+    """name 对应的 gambler id 名册中没有时分配新 id create 为 False 时返回 None"""
+    registry = _load_gambler_registry()
+    if name not in registry['ids']:
+        # 可能已由其他进程分配
+        registry = _load_gambler_registry(force=True)
+    while name not in registry['ids'] and create:
+        try:
+            logindb.gambler.insert_one({'_id': _next_gambler_id(), 'name': name})
+        except DuplicateKeyError:
+            # name 已被并发分配 或 id 已被导入的名册占用 重新读取后重试
+            pass
+        registry = _load_gambler_registry(force=True)
+    return registry['ids'].get(name)
+
+
+def find_gambler_name(gambler_id: int) -> str:
+    """gambler id 对应的名字 名册中没有时为 id 本身"""
+    names = _load_gambler_registry()['names']
+    if gambler_id not in names:
+        names = _load_gambler_registry(force=True)['names']
+    return names.get(gambler_id, str(gambler_id))
+
+
+def import_gambler_registry(docs: List[dict]) -> int:
+    """导入名册 返回新增的记录数 与已有记录的 id 或 name 冲突时 raise ValueError
+
+    之后分配的 id 从导入的最大 id 之后开始
+    """
+    inserted = 0
+    for d in docs:
+        try:
+            logindb.gambler.insert_one({'_id': d['_id'], 'name': d['name']})
+            inserted += 1
+        except DuplicateKeyError:
+            if logindb.gambler.find_one({'_id': d['_id']}) != {'_id': d['_id'], 'name': d['name']}:
+                raise ValueError(f'Conflicting gambler registry entry: {d}')
+    if docs:
+        logindb.meta.update_one({'_id': 'gambler_id'}, {'$max': {'seq': max(d['_id'] for d in docs)}}, upsert=True)
+    _gambler_registry.clear()
+    return inserted
+
+
 # class User:
 #     name = "user's name"
 #     openid = 'wechat openid'
@@ -27,6 +190,21 @@ class User(UserString):
         super(User, self).__init__(name)
         self.name = name
         self.openid = openid
+        self._id = None
+
+    @property
+    def id(self) -> int:
+        """名册中的 gambler id 首次访问时查找或分配 仅用于投注等写操作"""
+        if self._id is None:
+            self._id = find_gambler_id(self.name)
+        return self._id
+
+    @property
+    def known_id(self) -> Optional[int]:
+        """名册中的 gambler id 未分配时为 None 仅用于展示 不会写名册"""
+        if self._id is None:
+            self._id = find_gambler_id(self.name, create=False)
+        return self._id
 
     def _asdict(self):
         return dict(name=self.name, openid=self.openid)
@@ -37,6 +215,7 @@ def insert_user(name: str, openid: str) -> User:
     user = User(name=name, openid=openid)
     # 用 replace_one(upsert=True) 避免插入重复记录
     logindb.user.replace_one({'openid': openid}, user._asdict(), upsert=True)
+    _user_cache.pop(openid)
     return user
 
 
@@ -47,21 +226,75 @@ def drop_user(ident: str):
         return
     # login
     logindb.user.delete_one({'name': user.name, 'openid': user.openid})
-    # 不删除 match / auction / gambler 以免丢失历史数据
+    _user_cache.pop(user.openid)
+    # 不删除 match / auction / gambler 及名册 以免丢失历史数据
 
 
 def update_user_name(current: str, new: str):
-    """重命名 user"""
-    # login
-    logindb.user.update_one({'name': current}, {'$set': {'name': new}})
+    """重命名 user
+
+    各 tournament 中只保存 gambler id 只需改写名册 new 已被其他 user / gambler 使用时 raise ValueError
+    """
+    if current == new:
+        return
+    if logindb.gambler.find_one({'name': new}) or logindb.user.find_one({'name': new}):
+        raise ValueError(f'Name already in use: {new}')
+    # 先改写名册 name 的唯一索引阻止与并发的改名或新 gambler 重名
+    try:
+        logindb.gambler.update_one({'name': current}, {'$set': {'name': new}})
+    except DuplicateKeyError:
+        raise ValueError(f'Name already in use: {new}')
+    # login 改写失败时回滚名册 两者保持一致
+    try:
+        logindb.user.update_one({'name': current}, {'$set': {'name': new}})
+    except PyMongoError:
+        logindb.gambler.update_one({'name': new}, {'$set': {'name': current}})
+        raise
+    # 不知道 current 对应的 openid 直接清空缓存
+    clear_caches()
+    # team owner 缓存中的名字已过期
+    g.pop('team_owners', None)
+    # 比赛及积分榜中显示的名字已改变 令各 tournament 的 ETag 及比赛推送失效
     for tournament in TOURNAMENTS:
-        # match
-        dbclient[tournament.dbname].match.update_many({'a.gamblers': current}, {'$set': {'a.gamblers.$': new}})
-        dbclient[tournament.dbname].match.update_many({'b.gamblers': current}, {'$set': {'b.gamblers.$': new}})
-        # auction
-        dbclient[tournament.dbname].auction.update_many({'gambler': current}, {'$set': {'gambler': new}})
-        # gambler
-        dbclient[tournament.dbname].gambler.update_many({'name': current}, {'$set': {'name': new}})
+        bump_version('match', dbclient[tournament.dbname])
+        bump_version('standings', dbclient[tournament.dbname])
+
+
+def migrate_gambler_ids(db) -> Dict[str, int]:
+    """把 tournament 中以名字引用 gambler 的记录改为 gambler id 返回各 collection 改写的记录数
+
+    已是 id 的记录保持不变 可重复执行 积分榜需之后重建
+    """
+    def to_id(gambler):
+        return find_gambler_id(gambler) if isinstance(gambler, str) else gambler
+
+    # gambler 的唯一 key 由 name 改为 id 去掉 name 前先删除其唯一索引
+    if 'name_1' in db.gambler.index_information():
+        db.gambler.drop_index('name_1')
+    requests = dict(
+        gambler=[
+            UpdateOne({'_id': d['_id']}, {'$set': {'id': to_id(d['name'])}, '$unset': {'name': ''}})
+            for d in db.gambler.find({'name': {'$exists': True}}).sort('_id', pymongo.ASCENDING)
+        ],
+        auction=[
+            UpdateOne({'_id': d['_id']}, {'$set': {'gambler': to_id(d['gambler'])}})
+            for d in db.auction.find().sort('_id', pymongo.ASCENDING) if isinstance(d['gambler'], str)
+        ],
+        match=[
+            UpdateOne({'_id': d['_id']}, {'$set': {
+                f'{side}.gamblers': [to_id(x) for x in d[side]['gamblers']] for side in ('a', 'b')}})
+            for d in db.match.find({}, {'a.gamblers': True, 'b.gamblers': True}).sort('_id', pymongo.ASCENDING)
+            if any(isinstance(x, str) for side in ('a', 'b') for x in d[side]['gamblers'])
+        ],
+    )
+    for collection, r in requests.items():
+        if r:
+            db[collection].bulk_write(r, ordered=False)
+    if requests['match']:
+        bump_version('match', db)
+    clear_caches()
+    g.pop('team_owners', None)
+    return {collection: len(r) for collection, r in requests.items()}
 
 
 def find_user_by_name(name: str) -> Optional[User]:
@@ -73,54 +306,73 @@ def find_user_by_name(name: str) -> Optional[User]:
 
 
 def find_user_by_openid(openid: str) -> Optional[User]:
-    """根据 openid 获取 user"""
+    """根据 openid 获取 user 结果缓存 USER_CACHE_TTL 秒"""
+    if not openid:
+        return
+    user = _user_cache.get(openid)
+    if user:
+        return user
     d = logindb.user.find_one({'openid': openid})
     if not d:
         return
-    return User(name=d['name'], openid=d['openid'])
+    user = User(name=d['name'], openid=d['openid'])
+    _user_cache.set(openid, user)
+    return user
 
 
 # class Gambler:
 #     name = "gambler's name"
 
 class Gambler(User):
-    """参与到 tournament 中的 user"""
+    """参与到 tournament 中的 user 以名册中的 id 存入数据库"""
 
-    def __init__(self, g: Union[UserString, str]):
+    def __init__(self, g: Union[UserString, str], id: Optional[int] = None):
         super(Gambler, self).__init__(
             name=str(g),
             openid=getattr(g, 'openid', '<this-is-a-gambler>'),
         )
+        self._id = id if id is not None else getattr(g, '_id', None)
 
     def _asdict(self):
-        return dict(name=self.name)
+        return dict(id=self.id)
 
 
 def insert_gambler(g: Union[UserString, str]) -> Gambler:
     """插入若干个 gambler"""
     gambler = Gambler(g)
     # 用 replace_one(upsert=True) 避免插入重复记录
-    tournamentdb.gambler.replace_one({'name': gambler.name}, gambler._asdict(), upsert=True)
+    r = tournamentdb.gambler.replace_one({'id': gambler.id}, gambler._asdict(), upsert=True)
+    # 新 gambler 未投注的历史比赛均需扣分 重建积分榜
+    if r.upserted_id is not None:
+        refresh_standings()
     return gambler
 
 
 def find_gamblers() -> List[Gambler]:
     """获取本次 tournament 全部 gambler"""
-    return [Gambler(d['name']) for d in tournamentdb.gambler.find()]
+    return [Gambler(find_gambler_name(d['id']), id=d['id']) for d in tournamentdb.gambler.find()]
 
 
 # class Auction:
 #     team = 'england'
-#     gambler = "gambler's name"
+#     gambler = 1     # gambler id
 #     price = 23
 
 Auction = namedtuple('Auction', ['team', 'gambler', 'price'])
 
 
-def insert_auction(team: str, gambler: Gambler, price: int) -> Auction:
+def insert_auction(team: str, gambler: Union[Gambler, str], price: int) -> Auction:
     """插入拍卖记录"""
-    auction = Auction(team=team, gambler=str(gambler), price=price)
+    auction = Auction(team=team, gambler=Gambler(gambler).id, price=price)
     tournamentdb.auction.replace_one({'team': team}, auction._asdict(), upsert=True)
+    # 拍卖记录变化后 team owner 缓存失效
+    g.pop('team_owners', None)
+    # 从该 team 最早一场有比分的比赛起重算积分榜
+    _refresh_standings_after(tournamentdb.match.find_one(
+        {'$or': [{'a.team': team}, {'b.team': team}], 'a.score': {'$ne': None}, 'b.score': {'$ne': None}},
+        projection=STANDINGS_TRIGGER_FIELDS,
+        sort=[('match_time', pymongo.ASCENDING)],
+    ))
     return auction
 
 
@@ -139,41 +391,88 @@ def find_auctions() -> List[Auction]:
     ]
 
 
+def find_team_owners() -> Dict[str, Gambler]:
+    """获取本次 tournament 全部 team owner 以 team 为 key
+
+    一次查询取得全部拍卖记录 结果缓存在 g 中 直至 insert_auction 令其失效
+    """
+    cache = g.setdefault('team_owners', {})
+    if tournamentdb.name not in cache:
+        cache[tournamentdb.name] = {
+            a.team: Gambler(find_gambler_name(a.gambler), id=a.gambler) for a in find_auctions()}
+    return cache[tournamentdb.name]
+
+
 def find_team_owner(team: str) -> Optional[Gambler]:
     """根据拍卖记录查找 team owner"""
-    a = find_auction(team)
-    return Gambler(a.gambler) if a else None
+    return find_team_owners().get(team)
+
+
+# class Side:
+#     team = None
+#     premium = None
+#     score = None
+#     gamblers = []   # gambler id
+#     owner = None    # Gambler 不存入数据库
 
+class Side:
+    """比赛的一方 支持 side['team'] 形式的访问"""
 
-# class Match
+    __slots__ = ('team', 'premium', 'score', 'gamblers', 'owner')
+
+    def __init__(self, team, premium, score, gamblers, owner):
+        self.team = team
+        self.premium = premium
+        self.score = score
+        self.gamblers = gamblers
+        self.owner = owner
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __eq__(self, other):
+        return isinstance(other, Side) and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def _asdict(self) -> dict:
+        """存入数据库的结构 不含 owner"""
+        return dict(team=self.team, premium=self.premium, score=self.score, gamblers=self.gamblers)
+
+
+# class Match:
 #     id = None   # <%Y%m%d%H%M>-<team-a>-<team-b>
 #     league = None
 #     match_time = None
 #     handicap_display = None
-#     a = dict(
-#         team=None,
-#         premium=None,
-#         score=None,
-#         gamblers=[],
-#     )
-#     b = dict(
-#         team=None,
-#         premium=None,
-#         score=None,
-#         gamblers=[],
-#     )
+#     a = Side(...)
+#     b = Side(...)
 #     handicap = (None, None)
 #     weight = None
 
+# 积分榜结算只需的字段 比赛时间 比分 盘口 赌注 投注及用于查找 owner 的 team
+MATCH_SETTLEMENT_FIELDS = {
+    '_id': False, 'id': True, 'match_time': True, 'handicap': True, 'weight': True,
+    'a.team': True, 'a.score': True, 'a.gamblers': True,
+    'b.team': True, 'b.score': True, 'b.gamblers': True,
+}
+
+
 class Match:
 
+    __slots__ = ('league', 'match_time', 'handicap_display', 'handicap', 'a', 'b', 'weight', 'id', '_result')
+
     def __init__(
             self,
             league: str,
             match_time: datetime.datetime,
             handicap_display: str,
             team_a, team_b, premium_a, premium_b, score_a, score_b,
-            weight: int = 2, id=None):
+            weight: int = 2, id=None, owners: Optional[Dict[str, Gambler]] = None):
         self.league = league
 
         self.match_time = match_time
@@ -187,20 +486,12 @@ class Match:
             score_a = None
             score_b = None
 
-        self.a = dict(
-            team=team_a,
-            premium=float(premium_a),
-            score=score_a,
-            gamblers=[],
-            owner=find_team_owner(team=team_a),
-        )
-        self.b = dict(
-            team=team_b,
-            premium=float(premium_b),
-            score=score_b,
-            gamblers=[],
-            owner=find_team_owner(team=team_b),
-        )
+        # 未指定 owners 则使用本次 tournament 的 team owner 缓存
+        if owners is None:
+            owners = find_team_owners()
+
+        self.a = Side(team_a, float(premium_a), score_a, [], owners.get(team_a))
+        self.b = Side(team_b, float(premium_b), score_b, [], owners.get(team_b))
 
         self.weight = weight
         self.id = id or _generate_match_id(match_time, team_a, team_b)
@@ -208,19 +499,33 @@ class Match:
         self._result = None
 
     def __eq__(self, other):
-        return self._asdict() == other._asdict()
+        return isinstance(other, Match) and all(
+            getattr(self, k) == getattr(other, k) for k in self.__slots__ if k not in ('_result', 'a', 'b')
+        ) and self.a._asdict() == other.a._asdict() and self.b._asdict() == other.b._asdict()
 
     @classmethod
-    def from_mongo(cls, m: dict):  # -> Optional[Match]
-        """根据 mongo 返回的 record 构造 Match 对象"""
+    def from_mongo(cls, m: dict, owners: Optional[Dict[str, Gambler]] = None):  # -> Optional[Match]
+        """根据 mongo 返回的 record 构造 Match 对象
+
+        m 可以只含部分字段（如 MATCH_SETTLEMENT_FIELDS） 缺少的字段为 None
+        直接使用数据库中的 handicap 不再由 handicap_display 解析
+        """
         if not m:
             return
-        match = Match(league=m['league'], match_time=m['match_time'], handicap_display=m['handicap_display'],
-                      team_a=m['a']['team'], premium_a=m['a']['premium'], score_a=m['a']['score'],
-                      team_b=m['b']['team'], premium_b=m['b']['premium'], score_b=m['b']['score'],
-                      weight=m['weight'], id=m['id'])
-        match.a['gamblers'] = m['a']['gamblers']
-        match.b['gamblers'] = m['b']['gamblers']
+        # 未指定 owners 则使用本次 tournament 的 team owner 缓存
+        if owners is None:
+            owners = find_team_owners()
+        match = cls.__new__(cls)
+        match.league = m.get('league')
+        match.match_time = m['match_time']
+        match.handicap_display = m.get('handicap_display')
+        match.handicap = tuple(m['handicap'])
+        match.weight = m['weight']
+        match.id = m['id']
+        match._result = None
+        a, b = m['a'], m['b']
+        match.a = Side(a['team'], a.get('premium'), a['score'], a['gamblers'], owners.get(a['team']))
+        match.b = Side(b['team'], b.get('premium'), b['score'], b['gamblers'], owners.get(b['team']))
         return match
 
     @property
@@ -241,20 +546,13 @@ class Match:
 
         明确了哪些数据会被存入数据库持久化，而其他数据则只暂存在内存中
         """
-        def _team_asdict(team: dict) -> dict:
-            return dict(
-                team=team['team'],
-                premium=team['premium'],
-                score=team['score'],
-                gamblers=team['gamblers'],
-            )
         return dict(
             league=self.league,
             match_time=self.match_time,
             handicap_display=self.handicap_display,
             handicap=self.handicap,
-            a=_team_asdict(self.a),
-            b=_team_asdict(self.b),
+            a=self.a._asdict(),
+            b=self.b._asdict(),
             weight=self.weight,
             id=self.id,
         )
@@ -284,14 +582,14 @@ class Match:
         return False
 
     def update_profit_and_loss_result(self, required_gamblers: List[Gambler]) -> dict:
+        """逐场结算 返回以 gambler id 为 key 的损益"""
         # 比赛无比分则不计算损益
         if not self.has_score():
             return
 
         # 参与结算的玩家名单
         # 不指定则只在已投注玩家间结算
-        if required_gamblers is None:
-            required_gamblers = []
+        required_gamblers = [gambler.id for gambler in required_gamblers or []]
 
         self._result = dict(
             [(gambler, 0) for gambler in (self.a['gamblers'] + self.b['gamblers'] + required_gamblers)])
@@ -300,13 +598,11 @@ class Match:
         # 相当于将本场比赛拆成 n 个小比赛进行结算
         stack = self.weight / len(self.handicap)
 
-        for handicap in self.handicap:
-            # 找出未投注玩家
-            punish_gamblers = []
-            for gambler in required_gamblers:
-                if gambler not in self.a['gamblers'] and gambler not in self.b['gamblers']:
-                    punish_gamblers.append(gambler)
+        # 找出未投注玩家 各 handicap 相同 只需计算一次
+        bet_gamblers = set(self.a['gamblers']) | set(self.b['gamblers'])
+        punish_gamblers = [gambler for gambler in required_gamblers if gambler not in bet_gamblers]
 
+        for handicap in self.handicap:
             # 未投注直接扣分
             for gambler in punish_gamblers:
                 self._result[gambler] -= stack
@@ -332,9 +628,9 @@ class Match:
                 winner_reward = reward_sum / len(winner['gamblers'])
                 self._result[gambler] += winner_reward
 
-            # 主队奖励
-            winner_team_owner = find_team_owner(winner['team'])
-            loser_team_owner = find_team_owner(loser['team'])
+            # 主队奖励 owner 在构造 Match 时已取得
+            winner_team_owner = winner['owner'] and winner['owner'].id
+            loser_team_owner = loser['owner'] and loser['owner'].id
             if winner_team_owner in winner['gamblers']:
                 self._result[winner_team_owner] += winner_reward
             if winner_team_owner != loser_team_owner and loser_team_owner in winner['gamblers']:
@@ -378,23 +674,41 @@ def insert_match(
         return match
     # 否则插入新 match
     match = Match(league, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b, weight)
-    tournamentdb.match.insert_one(match._asdict())
+    try:
+        tournamentdb.match.insert_one(match._asdict())
+    except DuplicateKeyError:
+        # 并发插入时由 match.id 唯一索引保证只有一条记录
+        logging.info('Existing match: match={}'.format(match.id))
+        return find_match_by_id(match.id)
+    bump_version('match')
     logging.info('New match: match={}'.format(match.id))
+    if match.has_score():
+        refresh_standings(since=match.match_time)
     return match
 
 
-def update_match_score(match_id: str, score_a: str, score_b: str):
-    """更新比分"""
+def _parse_score(score_a, score_b) -> Optional[tuple]:
+    """解析比分 无法解析时返回 None"""
     try:
-        score_a = int(score_a)
-        score_b = int(score_b)
+        return int(score_a), int(score_b)
     except Exception:
+        return None
+
+
+def update_match_score(match_id: str, score_a: str, score_b: str):
+    """更新比分"""
+    score = _parse_score(score_a, score_b)
+    if not score:
         return
-    tournamentdb.match.update_one(
+    score_a, score_b = score
+    m = tournamentdb.match.find_one_and_update(
         {"id": match_id},
-        {"$set": {"a.score": score_a, "b.score": score_b}}
+        {"$set": {"a.score": score_a, "b.score": score_b}},
+        projection=STANDINGS_TRIGGER_FIELDS,
+        return_document=ReturnDocument.AFTER,
     )
     logging.info('Score updated: match={} score="{}:{}"'.format(match_id, score_a, score_b))
+    _match_updated(m)
 
 
 def update_match_handicap(match_id: str, handicap_display: str, cutoff_check=True):
@@ -403,19 +717,34 @@ def update_match_handicap(match_id: str, handicap_display: str, cutoff_check=Tru
     # 若比赛不存在或当前盘口已定则直接返回
     if not match or (cutoff_check and not match.can_update_handicap()):
         return
-    tournamentdb.match.update_one(
+    m = tournamentdb.match.find_one_and_update(
         {"id": match_id},
-        {"$set": {"handicap": _generate_handicap_pair(handicap_display), "handicap_display": handicap_display}}
+        {"$set": {"handicap": _generate_handicap_pair(handicap_display), "handicap_display": handicap_display}},
+        projection=STANDINGS_TRIGGER_FIELDS,
+        return_document=ReturnDocument.AFTER,
     )
     logging.info('Handicap updated: match={} handicap="{}"'.format(match_id, handicap_display))
+    _match_updated(m)
 
 
-def update_match_gamblers(match_id: str, team: Literal["a", "b"], gambler: Union[Gambler, User], cutoff_check=True):
-    """更新投注结果"""
-    match = find_match_by_id(match_id)
-    # 若比赛不存在或当前非投注时间则直接返回
-    if not match or (cutoff_check and not match.can_bet()):
-        return
+def _bet_time_window(now: datetime.datetime) -> dict:
+    """Match.can_bet() 对应的 match_time 查询条件
+
+    handicap_cutoff_time 为 match_time 之前最近的 12:00
+    因此 handicap_cutoff_time < now <= match_time 等价于 now <= match_time <= now 之后（含）最近的 12:00
+    """
+    noon = datetime.datetime(now.year, now.month, now.day, 12, 0, 0)
+    if noon < now:
+        noon += datetime.timedelta(days=1)
+    return {'$gte': now, '$lte': noon}
+
+
+def update_match_gamblers(
+        match_id: str, team: Literal["a", "b"], gambler: Union[Gambler, User], cutoff_check=True) -> bool:
+    """更新投注结果 返回投注是否成功
+
+    投注时间由查询条件保证 一次条件更新完成投注 不存在先查后写的竞争
+    """
     # 判断投注情况
     if team == 'a':
         # 投 a 队
@@ -426,18 +755,40 @@ def update_match_gamblers(match_id: str, team: Literal["a", "b"], gambler: Union
     else:
         # 除 a / b 以外则报错
         raise ValueError(f'Expect team to be: a or b, but got: {team}')
+    query = {"id": match_id}
+    if cutoff_check:
+        query['match_time'] = _bet_time_window(utc_to_beijing(datetime.datetime.utcnow()))
     # 更新 a / b 的 gamblers 列表
-    tournamentdb.match.update_one({"id": match_id}, {"$pull": {out: gambler.name}, "$addToSet": {in_: gambler.name}})
-    # 投注成功视作报名本次赛事
-    insert_gambler(gambler)
+    m = tournamentdb.match.find_one_and_update(
+        query,
+        {"$pull": {out: gambler.id}, "$addToSet": {in_: gambler.id}},
+        projection=STANDINGS_TRIGGER_FIELDS,
+        return_document=ReturnDocument.AFTER,
+    )
+    # 若比赛不存在或当前非投注时间则直接返回
+    if not m:
+        metrics.BETS.inc(result='rejected')
+        return False
+    metrics.BETS.inc(result='accepted')
+    # 投注成功视作报名本次赛事 已报名的 gambler 无需再次写入
+    known_gamblers = _known_gamblers.setdefault(tournamentdb.name, set())
+    if gambler.id not in known_gamblers:
+        # 新 gambler 会触发积分榜重建
+        insert_gambler(gambler)
+        known_gamblers.add(gambler.id)
+    _match_updated(m)
+    return True
 
 
 def update_match_weight(match_id: str, weight: int):
     """更新本场赌注"""
-    tournamentdb.match.update_one(
+    m = tournamentdb.match.find_one_and_update(
         {"id": match_id},
-        {"$set": {"weight": weight}}
+        {"$set": {"weight": weight}},
+        projection=STANDINGS_TRIGGER_FIELDS,
+        return_document=ReturnDocument.AFTER,
     )
+    _match_updated(m)
 
 
 def update_match_time(match_id: str, match_time: datetime.datetime):
@@ -452,12 +803,25 @@ def update_match_time(match_id: str, match_time: datetime.datetime):
         {"id": match_id},
         {"$set": {"id": _generate_match_id(match_time, match.a['team'], match.b['team']), "match_time": match_time}}
     )
+    bump_version('match')
+    # 比赛顺序可能改变 从较早的时间起重算积分榜
+    if match.has_score():
+        refresh_standings(since=min(match.match_time, match_time))
+
 
+def find_matches(reverse=False, limit=0, projection: Optional[dict] = None, before: Optional[str] = None) -> List[Match]:
+    """返回所有比赛 默认为 id 升序 projection 为 None 时读取完整记录
 
-def find_matches(reverse=False, limit=0) -> List[Match]:
-    """返回所有比赛 默认为 id 升序"""
+    before 不为空时只返回 id 小于 before 的比赛 与 reverse=True 配合实现按 id 的 keyset 分页
+    """
     direction = pymongo.DESCENDING if reverse else pymongo.ASCENDING
-    return [Match.from_mongo(m) for m in tournamentdb.match.find().sort('id', direction=direction).limit(limit)]
+    query = {'id': {'$lt': before}} if before else {}
+    # 全部比赛共用一次查询得到的 team owner
+    owners = find_team_owners()
+    return [
+        Match.from_mongo(m, owners=owners)
+        for m in tournamentdb.match.find(query, projection).sort('id', direction=direction).limit(limit)
+    ]
 
 
 def find_match_by_id(match_id: str) -> Optional[Match]:
@@ -465,8 +829,120 @@ def find_match_by_id(match_id: str) -> Optional[Match]:
     return Match.from_mongo(tournamentdb.match.find_one({'id': match_id}))
 
 
+def find_matches_by_ids(match_ids: List[str]) -> Dict[str, Match]:
+    """一次查询返回指定 ID 的全部比赛 以 id 为 key"""
+    owners = find_team_owners()
+    return {
+        m['id']: Match.from_mongo(m, owners=owners)
+        for m in tournamentdb.match.find({'id': {'$in': list(match_ids)}})
+    }
+
+
+def bulk_write_matches(requests: list, since: Optional[datetime.datetime] = None):
+    """按顺序批量写入比赛 since 不为 None 时从 since 起重算积分榜"""
+    if requests:
+        r = tournamentdb.match.bulk_write(requests, ordered=True)
+        logging.info('Matches written: upserted={} modified={}'.format(r.upserted_count, r.modified_count))
+        if r.upserted_count or r.modified_count:
+            bump_version('match')
+    if since is not None:
+        refresh_standings(since=since)
+
+
+# index 页面实时更新的字段
+MATCH_EVENT_FIELDS = {
+    '_id': False, 'id': True, 'weight': True, 'handicap_display': True,
+    'a.gamblers': True, 'a.score': True, 'b.gamblers': True, 'b.score': True,
+}
+
+
+def _match_event(m: dict) -> dict:
+    """比赛中推送给 index 页面的字段 gambler 为名字"""
+    return dict(
+        id=m['id'], weight=m['weight'], handicap_display=m['handicap_display'],
+        a=dict(gamblers=[find_gambler_name(i) for i in m['a']['gamblers']], score=m['a']['score']),
+        b=dict(gamblers=[find_gambler_name(i) for i in m['b']['gamblers']], score=m['b']['score']),
+    )
+
+
+def watch_matches(interval: float, timeout: float) -> Iterator[List[dict]]:
+    """持续返回发生变化的比赛 每 interval 秒至少返回一次（无变化时为空列表） timeout 秒后结束
+
+    优先使用 change streams 数据库不支持时（非 replica set）退回为轮询 match 版本号
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        stream = tournamentdb.match.watch(
+            [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}],
+            full_document='updateLookup')
+    except OperationFailure as e:
+        logging.info(f'Change streams unavailable, polling instead: {e}')
+        yield from _poll_matches(interval, deadline)
+    else:
+        yield from _stream_matches(stream, interval, deadline)
+
+
+def _stream_matches(stream, interval: float, deadline: float) -> Iterator[List[dict]]:
+    """由后台线程读取 change stream 以便按 interval 返回心跳"""
+    changes = queue.Queue()
+
+    def _watch():
+        try:
+            for change in stream:
+                # 更新后比赛已被删除时 fullDocument 为 None
+                if change.get('fullDocument'):
+                    changes.put(_match_event(change['fullDocument']))
+        except PyMongoError:
+            # stream 已被关闭
+            pass
+
+    threading.Thread(target=_watch, daemon=True).start()
+    try:
+        while time.monotonic() < deadline:
+            try:
+                changed = [changes.get(timeout=interval)]
+            except queue.Empty:
+                changed = []
+            while not changes.empty():
+                changed.append(changes.get_nowait())
+            yield changed
+    finally:
+        stream.close()
+
+
+def _find_match_events(version: int) -> Dict[str, dict]:
+    """match 版本号对应的全部比赛推送字段 每个版本在进程内只读取一次 供全部连接共用"""
+    with _match_events_lock:
+        cached = _match_events.get(tournamentdb.name)
+        if cached and cached[0] == version:
+            return cached[1]
+        events = {m['id']: _match_event(m) for m in tournamentdb.match.find({}, MATCH_EVENT_FIELDS)}
+        _match_events[tournamentdb.name] = (version, events)
+        return events
+
+
+def _poll_matches(interval: float, deadline: float) -> Iterator[List[dict]]:
+    """轮询 match 版本号 版本变化时取得全部比赛并与上次结果比较
+
+    每次轮询只读取版本号 同一进程内的连接共用同一版本的比赛 第一次返回空列表 作为之后比较的基准
+    """
+    version, snapshot = None, {}
+    while True:
+        changed = []
+        current = find_version('match')
+        if current != version:
+            events = _find_match_events(current)
+            if version is not None:
+                changed = [e for match_id, e in events.items() if snapshot.get(match_id) != e]
+            version, snapshot = current, events
+        yield changed
+        if time.monotonic() + interval >= deadline:
+            return
+        time.sleep(interval)
+
+
 # class Series:
-#     gambler = 'name1'
+#     gambler = 'name1'   # 名字 结算结果以 gambler id 为 key
 #     points = OrderedDict([
 #         ('201806010100-法国-西班牙', 17),
 #         ('201806010330-英格兰-德国', 15),
@@ -474,22 +950,230 @@ def find_match_by_id(match_id: str) -> Optional[Match]:
 
 class Series:
 
-    def __init__(self, gambler: str, matches: list, required_gamblers: List[Gambler]):
-        self.gambler = gambler
+    def __init__(self, gambler: Gambler, results: 'OrderedDict[str, dict]'):
+        self.gambler = gambler.name
         self.points = OrderedDict()
-        self._add_matches(matches, required_gamblers)
+        self._add_results(gambler.id, results)
 
-    def _add_matches(self, matches: list, required_gamblers: List[Gambler]):
+    def _add_results(self, gambler_id: int, results: 'OrderedDict[str, dict]'):
         latest = 0
-        for match in sorted(matches, key=lambda m: m.match_time):
-            if not match.has_score():
-                continue
-            result = match.update_profit_and_loss_result(required_gamblers=required_gamblers)
-            latest += result and result.get(self.gambler) or 0
-            self.points[match.id] = latest
+        for match_id, result in results.items():
+            latest += result and result.get(gambler_id) or 0
+            self.points[match_id] = latest
+
+    @classmethod
+    def from_points(cls, gambler: str, points: 'OrderedDict[str, float]'):  # -> Series
+        series = cls.__new__(cls)
+        series.gambler = gambler
+        series.points = points
+        return series
+
 
+def settle_matches(matches: List[Match], required_gamblers: List[Gambler]) -> 'OrderedDict[str, dict]':
+    """按比赛时间顺序结算全部有比分的比赛 返回以 match id 为 key 的损益结果
 
+    每场比赛只结算一次 全部 gambler 的 Series 共用同一份结果
+    """
+    results = OrderedDict()
+    for match in sorted(matches, key=lambda m: (m.match_time, m.id)):
+        if not match.has_score():
+            continue
+        results[match.id] = match.update_profit_and_loss_result(required_gamblers=required_gamblers)
+    return results
+
+
+@metrics.SETTLEMENT_SECONDS.time(function='generate_series')
 def generate_series() -> List[Series]:
     gamblers = find_gamblers()
-    matches = find_matches()
-    return [Series(gambler.name, matches, gamblers) for gambler in gamblers]
+    ids = [gambler.id for gambler in gamblers]
+    # 以数组运算一次结算整个 tournament
+    s = settlement.settle(find_matches(projection=MATCH_SETTLEMENT_FIELDS), ids)
+    return [Series.from_points(gambler.name, points) for gambler, points in zip(gamblers, s.points(ids))]
+
+
+# class Standing:
+#     id = '201806010100-法国-西班牙'
+#     match_time = datetime.datetime(2018, 6, 1, 1, 0)
+#     gamblers = [1, 2]      # gambler id
+#     points = [17, -3]      # 与 gamblers 一一对应的累计积分
+
+# 结算相关字段 写操作据此判断是否需要重算积分榜
+STANDINGS_TRIGGER_FIELDS = {'_id': False, 'match_time': True, 'a.score': True, 'b.score': True}
+
+STANDINGS_ORDER = [('match_time', pymongo.ASCENDING), ('id', pymongo.ASCENDING)]
+
+
+# 积分榜重算的互斥锁 持有者异常退出时 STANDINGS_LOCK_TTL 后自动失效
+STANDINGS_LOCK_TTL = datetime.timedelta(seconds=30)
+STANDINGS_LOCK_POLL = 0.05
+
+
+@contextlib.contextmanager
+def _standings_lock():
+    """以 meta 中的锁文档串行化同一 tournament 的积分榜重算 多个进程之间同样有效
+
+    锁被占用时 upsert 与已有的锁文档 _id 冲突 等待后重试
+    """
+    owner = ObjectId()
+    while True:
+        now = datetime.datetime.utcnow()
+        try:
+            tournamentdb.meta.update_one(
+                {'_id': 'standings_lock', 'expires_at': {'$lt': now}},
+                {'$set': {'owner': owner, 'expires_at': now + STANDINGS_LOCK_TTL}}, upsert=True)
+            break
+        except DuplicateKeyError:
+            time.sleep(STANDINGS_LOCK_POLL)
+    try:
+        yield
+    finally:
+        tournamentdb.meta.delete_one({'_id': 'standings_lock', 'owner': owner})
+
+
+@metrics.SETTLEMENT_SECONDS.time(function='refresh_standings')
+def refresh_standings(since: Optional[datetime.datetime] = None):
+    """重算积分榜中 since 及之后的比赛 since 为 None 时重建整个积分榜
+
+    积分榜为每场已结算比赛保存全部 gambler 的累计积分 since 之前的部分保持不变
+    同一 tournament 的重算依次执行 后执行者读取到的比赛总是更新
+    """
+    with _standings_lock():
+        _refresh_standings(since)
+    bump_version('standings')
+
+
+def _refresh_standings(since: Optional[datetime.datetime]):
+    gamblers = [gambler.id for gambler in find_gamblers()]
+
+    query = {}
+    previous = {}
+    if since is not None:
+        query = {'match_time': {'$gte': since}}
+        # 取得 since 之前最后一场比赛的累计积分
+        d = tournamentdb.standings.find_one(
+            {'match_time': {'$lt': since}}, sort=[(k, pymongo.DESCENDING) for k, _ in STANDINGS_ORDER])
+        if d:
+            previous = dict(zip(d['gamblers'], d['points']))
+
+    owners = find_team_owners()
+    matches = [Match.from_mongo(m, owners=owners) for m in tournamentdb.match.find(query, MATCH_SETTLEMENT_FIELDS)]
+    match_times = {m.id: m.match_time for m in matches}
+
+    s = settlement.settle(matches, gamblers)
+    cumulative = s.cumulative(initial=previous)[:, [s.index[gambler] for gambler in gamblers]]
+    standings = [
+        dict(id=match_id, match_time=match_times[match_id], gamblers=gamblers, points=points)
+        for match_id, points in zip(s.match_ids, cumulative.tolist())
+    ]
+
+    # 逐行 upsert 再删除不再结算的比赛 即使锁已过期与其他重算重叠 也不会因唯一索引失败
+    if standings:
+        tournamentdb.standings.bulk_write([ReplaceOne({'id': d['id']}, d, upsert=True) for d in standings], ordered=False)
+    tournamentdb.standings.delete_many(dict(query, id={'$nin': [d['id'] for d in standings]}))
+    logging.info('Standings refreshed: since={} count={}'.format(since, len(standings)))
+
+
+def _refresh_standings_after(m: Optional[dict]):
+    """比赛已有比分时 重算该比赛及之后的积分榜"""
+    if m and m['a']['score'] is not None and m['b']['score'] is not None:
+        refresh_standings(since=m['match_time'])
+
+
+def _match_updated(m: Optional[dict]):
+    """比赛被改写后 递增 match 版本号并按需重算积分榜"""
+    if m:
+        bump_version('match')
+    _refresh_standings_after(m)
+
+
+def find_standings() -> List[Series]:
+    """从积分榜读取全部 gambler 的 Series 与 generate_series() 的结果一致"""
+    many_series = OrderedDict()
+    for d in tournamentdb.standings.find().sort(STANDINGS_ORDER):
+        for gambler_id, points in zip(d['gamblers'], d['points']):
+            if gambler_id not in many_series:
+                many_series[gambler_id] = Series.from_points(find_gambler_name(gambler_id), OrderedDict())
+            many_series[gambler_id].points[d['id']] = points
+    return list(many_series.values())
+
+
+# class AllTimeStanding:
+#     gambler = 'name1'
+#     total = 120.5
+#     points = OrderedDict([
+#         ('worldcup2018', 92.33),
+#         ('worldcup2022', 28.17),
+#     ])
+
+AllTimeStanding = namedtuple('AllTimeStanding', ['gambler', 'total', 'points'])
+
+_all_time_executor = None
+
+
+def _get_all_time_executor() -> ProcessPoolExecutor:
+    """进程内共享的进程池 使用 spawn 避免子进程继承已连接的 MongoClient
+
+    子进程先导入 worldcup.app 再反序列化任务 与 flask 的导入顺序一致 避免循环导入
+    """
+    global _all_time_executor
+    if _all_time_executor is None:
+        _all_time_executor = ProcessPoolExecutor(
+            max_workers=min(len(TOURNAMENTS), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=importlib.import_module,
+            initargs=('worldcup.app',),
+        )
+    return _all_time_executor
+
+
+def _settle_tournament(tournament: Tournament) -> Dict[int, float]:
+    """结算整个 tournament 返回以 gambler id 为 key 的最终积分 供进程池调用"""
+    with app.app_context():
+        g.tournament = tournament
+        gamblers = [gambler.id for gambler in find_gamblers()]
+        s = settlement.settle(find_matches(projection=MATCH_SETTLEMENT_FIELDS), gamblers)
+        if not s.match_ids:
+            return {gambler: 0 for gambler in gamblers}
+        final = s.cumulative()[-1]
+        return {gambler: float(final[s.index[gambler]]) for gambler in gamblers}
+
+
+def _final_standings(tournament: Tournament) -> Dict[int, float]:
+    """读取积分榜的最后一行 与 _settle_tournament() 的结果一致"""
+    db = dbclient[tournament.dbname]
+    d = db.standings.find_one({}, sort=[(k, pymongo.DESCENDING) for k, _ in STANDINGS_ORDER]) or {}
+    points = dict(zip(d.get('gamblers', []), d.get('points', [])))
+    # 尚无已结算比赛时积分榜为空 积分均为 0
+    gamblers = [gambler['id'] for gambler in db.gambler.find({}, {'_id': False, 'id': True})]
+    return {gambler: points.get(gambler, 0) for gambler in gamblers}
+
+
+def generate_all_time_standings(resettle=False, parallel=True) -> List[AllTimeStanding]:
+    """按 gambler 合并全部 tournament 的最终积分 按总积分降序排列
+
+    默认读取各 tournament 已物化的积分榜
+    resettle 为 True 时重新结算全部 tournament 用于校验积分榜 各 tournament 互不依赖 默认在进程池中并行结算
+    gambler id 在全部 tournament 中共用 按 id 合并后再取名字
+    """
+    if not resettle:
+        results = [_final_standings(tournament) for tournament in TOURNAMENTS]
+    elif parallel:
+        try:
+            results = list(_get_all_time_executor().map(_settle_tournament, TOURNAMENTS))
+        except BrokenProcessPool:
+            # 子进程异常退出时丢弃进程池 下次调用重新创建
+            global _all_time_executor
+            _all_time_executor = None
+            raise
+    else:
+        results = [_settle_tournament(tournament) for tournament in TOURNAMENTS]
+
+    merged = OrderedDict()
+    for tournament, points in zip(TOURNAMENTS, results):
+        for gambler, p in points.items():
+            merged.setdefault(gambler, OrderedDict())[tournament.dbname] = p
+    standings = [
+        AllTimeStanding(find_gambler_name(gambler_id), sum(points.values()), points)
+        for gambler_id, points in merged.items()
+    ]
+    return sorted(standings, key=lambda s: s.total, reverse=True)
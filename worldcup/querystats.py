@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import contextlib
+import threading
+from typing import Optional
+
+from flask import g, has_app_context
+from pymongo import monitoring
+
+
+class QueryStats:
+    """一次请求内的数据库命令统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.slowest = None
+        self.slowest_ms = 0.0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        target = f'{event.database_name}.{collection}' if isinstance(collection, str) else event.database_name
+        with self._lock:
+            self._pending[event.request_id] = f'{event.command_name} {target}'
+
+    def finished(self, event):
+        """CommandSucceededEvent 或 CommandFailedEvent"""
+        ms = event.duration_micros / 1000
+        with self._lock:
+            command = self._pending.pop(event.request_id, event.command_name)
+            self.count += 1
+            self.total_ms += ms
+            if self.slowest is None or ms > self.slowest_ms:
+                self.slowest, self.slowest_ms = command, ms
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头"""
+        timing = f'db;desc="{self.count} queries";dur={self.total_ms:.3f}'
+        if self.slowest:
+            timing += f', db-slowest;desc="{self.slowest}";dur={self.slowest_ms:.3f}'
+        return timing
+
+    def _asdict(self) -> dict:
+        return dict(count=self.count, total_ms=round(self.total_ms, 3),
+                    slowest=self.slowest, slowest_ms=round(self.slowest_ms, 3))
+
+
+def current() -> Optional[QueryStats]:
+    """当前 app context 中正在统计的 QueryStats 不在 app context 中时为 None"""
+    return g.get('query_stats') if has_app_context() else None
+
+
+class QueryListener(monitoring.CommandListener):
+    """把数据库命令计入当前请求的 QueryStats
+
+    pymongo 在发出命令的线程中同步调用 listener 因此可以直接使用 flask.g
+    """
+
+    def started(self, event):
+        stats = current()
+        if stats is not None:
+            stats.started(event)
+
+    def succeeded(self, event):
+        stats = current()
+        if stats is not None:
+            stats.finished(event)
+
+    def failed(self, event):
+        stats = current()
+        if stats is not None:
+            stats.finished(event)
+
+
+@contextlib.contextmanager
+def track():
+    """统计 with 块内的数据库命令 需在 app context 中使用"""
+    previous = g.get('query_stats')
+    g.query_stats = stats = QueryStats()
+    try:
+        yield stats
+    finally:
+        g.query_stats = previous
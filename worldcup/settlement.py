@@ -0,0 +1,133 @@
+# coding: utf-8
+
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+# 投注方向
+NONE, SIDE_A, SIDE_B = 0, 1, 2
+
+
+class Settlement:
+    """整个 tournament 的结算结果
+
+    results[i, j] 为 gamblers[j] 在 match_ids[i] 中的损益 比赛按 (match_time, id) 排序 gamblers 为 gambler id
+    """
+
+    def __init__(self, match_ids: List[str], gamblers: List[int], results: np.ndarray):
+        self.match_ids = match_ids
+        self.gamblers = gamblers
+        self.results = results
+        self.index = {gambler: j for j, gambler in enumerate(gamblers)}
+
+    def cumulative(self, initial: Optional[Dict[int, float]] = None) -> np.ndarray:
+        """每场比赛后的累计积分 initial 为第一场之前的积分
+
+        np.cumsum 按顺序逐行累加 与逐场累加的浮点结果完全一致
+        """
+        start = np.zeros((1, len(self.gamblers)))
+        for gambler, points in (initial or {}).items():
+            if gambler in self.index:
+                start[0, self.index[gambler]] = points
+        return np.cumsum(np.vstack([start, self.results]), axis=0)[1:]
+
+    def points(self, gamblers: List[int]) -> 'List[OrderedDict[str, float]]':
+        """gamblers 每场比赛后的累计积分 以 match id 为 key"""
+        cumulative = self.cumulative()
+        return [
+            OrderedDict(zip(self.match_ids, cumulative[:, self.index[gambler]].tolist()))
+            for gambler in gamblers
+        ]
+
+
+def _owner_index(index: np.ndarray, owner) -> int:
+    """owner 的列号 无 owner 或 owner 未参与结算时为 -1"""
+    if owner is None or owner.id >= len(index):
+        return -1
+    return int(index[owner.id])
+
+
+def settle(matches: list, required_gamblers: List[int]) -> Settlement:
+    """以数组运算结算全部有比分的比赛 结果与 Match.update_profit_and_loss_result() 逐场结算一致
+
+    required_gamblers 及比赛中的 gamblers 均为 gambler id
+
+    各项加减的顺序与逐场结算相同 以保证浮点结果完全一致
+    每个 gambler 每个 handicap 至多得到一项基础损益（未投注扣分 / 输家扣分 / 赢家奖励）和一项主队奖励
+    """
+    matches = sorted((m for m in matches if m.has_score()), key=lambda m: (m.match_time, m.id))
+
+    # gambler 编号 先为参与结算的玩家 再为其他已投注玩家
+    gamblers = OrderedDict((g, None) for g in required_gamblers)
+    for m in matches:
+        for g in m.a['gamblers'] + m.b['gamblers']:
+            gamblers.setdefault(g, None)
+    gamblers = list(gamblers)
+    n_matches, n_gamblers = len(matches), len(gamblers)
+    if not matches:
+        return Settlement([], gamblers, np.zeros((0, n_gamblers)))
+
+    # gambler id -> 列号 以 id 直接索引
+    index = np.full(max(gamblers, default=-1) + 1, -1, dtype=np.int64)
+    index[gamblers] = np.arange(n_gamblers)
+
+    # 投注矩阵 gambler × match
+    side = np.full((n_matches, n_gamblers), NONE, dtype=np.int8)
+    owner_a = np.full(n_matches, -1, dtype=np.int64)
+    owner_b = np.full(n_matches, -1, dtype=np.int64)
+    for i, m in enumerate(matches):
+        side[i, index[m.a['gamblers']]] = SIDE_A
+        side[i, index[m.b['gamblers']]] = SIDE_B
+        owner_a[i] = _owner_index(index, m.a['owner'])
+        owner_b[i] = _owner_index(index, m.b['owner'])
+
+    required = np.zeros(n_gamblers, dtype=bool)
+    required[index[list(required_gamblers)]] = True
+
+    score_diff = np.array([m.a['score'] - m.b['score'] for m in matches], dtype=np.float64)
+    handicaps = np.array([m.handicap for m in matches], dtype=np.float64).reshape(n_matches, -1)
+    stack = np.array([m.weight for m in matches], dtype=np.float64) / handicaps.shape[1]
+
+    punished = required & (side == NONE)
+    n_a = (side == SIDE_A).sum(axis=1)
+    n_b = (side == SIDE_B).sum(axis=1)
+    n_punished = punished.sum(axis=1)
+
+    rows = np.arange(n_matches)
+    results = np.zeros((n_matches, n_gamblers))
+    for k in range(handicaps.shape[1]):
+        # 未投注直接扣分
+        results = results + np.where(punished, -stack[:, None], 0.0)
+
+        # 根据 score + handicap 计算输家赢家 平局不再结算
+        a_wins = score_diff > handicaps[:, k]
+        b_wins = score_diff < handicaps[:, k]
+        winner = np.where(a_wins, SIDE_A, np.where(b_wins, SIDE_B, NONE))
+        loser = np.where(a_wins, SIDE_B, np.where(b_wins, SIDE_A, NONE))
+        n_winner = np.where(a_wins, n_a, n_b)
+        n_loser = np.where(a_wins, n_b, n_a)
+
+        # 给赢家的总奖励是输家的赌注和 由赢家平分
+        reward_sum = stack * (n_loser + n_punished)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reward = np.where(n_winner > 0, reward_sum / np.maximum(n_winner, 1), 0.0)
+
+        is_winner = (side == winner[:, None]) & (winner[:, None] != NONE)
+        is_loser = (side == loser[:, None]) & (loser[:, None] != NONE)
+        results = results + np.where(is_loser, -stack[:, None], np.where(is_winner, reward[:, None], 0.0))
+
+        # 主队奖励 owner 在赢家之列时再得一份奖励
+        winner_owner = np.where(a_wins, owner_a, owner_b)
+        loser_owner = np.where(a_wins, owner_b, owner_a)
+        bonus = np.zeros((n_matches, n_gamblers))
+        for owner, cond in (
+                (winner_owner, winner != NONE),
+                (loser_owner, (winner != NONE) & (loser_owner != winner_owner))):
+            cond = cond & (owner >= 0)
+            cond[cond] &= side[rows[cond], owner[cond]] == winner[cond]
+            bonus[rows[cond], owner[cond]] = reward[cond]
+        results = results + bonus
+
+    return Settlement([m.id for m in matches], gamblers, results)
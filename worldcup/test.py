@@ -1,7 +1,15 @@
 import datetime
 import bson.json_util
+import json
 import os
+import re
+import pymongo
 import pytest
+import requests
+import subprocess
+import sys
+import threading
+import time
 
 from collections import OrderedDict
 from freezegun import freeze_time
@@ -11,17 +19,23 @@ from worldcup import config
 config.TOURNAMENTS.append(config.Tournament(dbname='veryhard', league='欧联', display='硬糙', weight_schedule=[]))
 config.DEFAULT_TOURNAMENT = config.TOURNAMENTS[-1]
 
-from worldcup.app import app, logindb, tournamentdb as db
-from worldcup import model
+from worldcup.app import app, logindb, tournamentdb as db, BET_REJECTED
+from worldcup import model, match_getter, settlement, cli, querystats, metrics, acw_solver, bench
 
 
 def drop_all():
     # login
     logindb.user.drop()
+    logindb.gambler.drop()
+    logindb.meta.drop()
     # tournament
     db.gambler.drop()
     db.match.drop()
     db.auction.drop()
+    db.standings.drop()
+    db.meta.drop()
+    # cache
+    model.clear_caches()
 
 
 @pytest.fixture(autouse=True)
@@ -122,6 +136,21 @@ def test_find_one_user(g1u):
     assert model.find_user_by_name('non-existent') is None
 
 
+def test_model_user_cache(g1u):
+    assert model.find_user_by_openid(g1u.openid) == g1u
+    # 缓存命中时不再查询数据库
+    logindb.user.update_one({'openid': g1u.openid}, {'$set': {'name': 'g1-renamed'}})
+    assert model.find_user_by_openid(g1u.openid).name == 'g1'
+
+    # update_user_name 令缓存失效
+    model.update_user_name(current='g1-renamed', new='巨型钻')
+    assert model.find_user_by_openid(g1u.openid).name == '巨型钻'
+
+    # drop_user 令缓存失效
+    model.drop_user(g1u.openid)
+    assert model.find_user_by_openid(g1u.openid) is None
+
+
 def test_model_find_gamblers(g1, g2, g3, g4):
     gamblers_found = model.find_gamblers()
     assert gamblers_found == [g1, g2, g3, g4]
@@ -138,6 +167,18 @@ def test_model_find_team_owner(auction2, g4):
     assert team_owner == g4
 
 
+def test_model_find_team_owners(match1, g4):
+    # 无拍卖记录
+    assert model.find_team_owners() == {}
+    assert model.find_match_by_id(match1.id).a['owner'] is None
+
+    # insert_auction 令 team owner 缓存失效
+    model.insert_auction(team='水宫', gambler=g4, price=12)
+    assert model.find_team_owners() == {'水宫': g4}
+    assert model.find_match_by_id(match1.id).a['owner'] == g4
+    assert model.find_matches()[0].a['owner'] == g4
+
+
 def test_model_find_match_by_id(match1):
     found = model.find_match_by_id(match1.id)
     assert found == match1
@@ -150,6 +191,26 @@ def test_model_find_matches(match1, match2):
     matches_found = model.find_matches(reverse=True, limit=1)
     assert matches_found == [match2]
 
+    matches_found = model.find_matches(reverse=True, limit=1, before=match2.id)
+    assert matches_found == [match1]
+
+
+def test_model_find_matches_projection(auction2, match1, match2):
+    matches = model.find_matches(projection=model.MATCH_SETTLEMENT_FIELDS)
+    assert [m.id for m in matches] == [match1.id, match2.id]
+    # 结算所需字段与完整记录一致
+    for m, full in zip(matches, [match1, match2]):
+        assert (m.match_time, m.handicap, m.weight) == (full.match_time, full.handicap, full.weight)
+        for side, full_side in [(m.a, full.a), (m.b, full.b)]:
+            assert (side['team'], side['score'], side['gamblers']) == (full_side['team'], full_side['score'], full_side['gamblers'])
+        assert (m.league, m.handicap_display, m.a['premium']) == (None, None, None)
+    assert matches[1].a['owner'] == 'g4'
+
+    with pytest.raises(KeyError):
+        matches[0].a['missing']
+    with pytest.raises(AttributeError):
+        matches[0].extra = 1
+
 
 ##########
 # data manipulation tests
@@ -166,9 +227,9 @@ def test_model_drop_user(auction2, match1, match2, g1):
     assert not model.find_user_by_name(g1.name)
 
     # match / auction remains untouched
-    assert db.match.find({'a.gamblers': g1.name}).count() == 1
-    assert db.match.find({'b.gamblers': g1.name}).count() == 1
-    assert db.auction.find({'gambler': g1.name}).count() == 2
+    assert db.match.find({'a.gamblers': g1.id}).count() == 1
+    assert db.match.find({'b.gamblers': g1.id}).count() == 1
+    assert db.auction.find({'gambler': g1.id}).count() == 2
 
 
 def test_model_update_user_name(auction2, match1, match2, g1, g2):
@@ -176,15 +237,22 @@ def test_model_update_user_name(auction2, match1, match2, g1, g2):
 
     model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
     model.update_match_gamblers(match2.id, 'b', g1, cutoff_check=False)
+    model.refresh_standings()
+    version = model.find_version('match')
+    matches = list(db.match.find({}, {'_id': False}))
 
     model.update_user_name(current=g1.name, new=G1_NEW)
     # gambler
     assert model.find_user_by_name(G1_NEW)
-    # match
-    assert db.match.find({'a.gamblers': G1_NEW}).count() == 1
-    assert db.match.find({'b.gamblers': G1_NEW}).count() == 1
-    # auction
-    assert db.auction.find({'gambler': G1_NEW}).count() == 2
+    assert model.find_gambler_id(G1_NEW, create=False) == g1.id
+    assert model.find_gambler_id(g1.name, create=False) is None
+    # match / auction 中的 id 保持不变 只有名册被改写
+    assert list(db.match.find({}, {'_id': False})) == matches
+    assert model.find_team_owner('莱特城').name == G1_NEW
+    assert G1_NEW in model.find_gamblers()
+    assert G1_NEW in [s.gambler for s in model.find_standings()]
+    # ETag 失效
+    assert model.find_version('match') == version + 1
 
     G2_NEW = '小型钻'
 
@@ -195,10 +263,99 @@ def test_model_update_user_name(auction2, match1, match2, g1, g2):
     # gambler
     assert model.find_user_by_name(G2_NEW)
     # match
-    assert db.match.find({'a.gamblers': G2_NEW}).count() == 0
-    assert db.match.find({'b.gamblers': G2_NEW}).count() == 2
-    # auction
-    assert db.auction.find({'gambler': G2_NEW}).count() == 2
+    assert [m.b.gamblers for m in model.find_matches()] == [[g2.id], [g1.id, g2.id]]
+    assert [model.find_gambler_name(x) for x in model.find_match_by_id(match2.id).b.gamblers] == [G1_NEW, G2_NEW]
+
+
+def test_model_update_user_name_conflict(monkeypatch, g1, g2):
+    # 与已有 gambler 重名
+    with pytest.raises(ValueError):
+        model.update_user_name(current=g1.name, new=g2.name)
+    assert (model.find_gambler_name(g1.id), model.find_gambler_name(g2.id)) == (g1.name, g2.name)
+    assert model.find_user_by_name(g1.name) and model.find_user_by_name(g2.name)
+
+    r = app.test_cli_runner().invoke(args=['rename_user', g1.name, g2.name])
+    assert r.exit_code == 1 and 'Name already in use' in r.output
+
+    # login 改写失败时回滚名册
+    update_one = type(logindb.user).update_one
+
+    def fail_user(self, *args, **kwargs):
+        if self.name == 'user':
+            raise pymongo.errors.AutoReconnect('failover')
+        return update_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(logindb.user), 'update_one', fail_user)
+    with pytest.raises(pymongo.errors.AutoReconnect):
+        model.update_user_name(current=g1.name, new='巨型钻')
+    assert logindb.gambler.find_one({'_id': g1.id})['name'] == g1.name
+    assert model.find_user_by_name(g1.name)
+
+
+def test_model_gambler_registry(g1):
+    model.ensure_indexes()
+    assert model.find_gambler_id(g1.name) == g1.id
+    assert model.find_gambler_name(g1.id) == g1.name
+    assert model.find_gambler_id('non-existent', create=False) is None
+    assert model.find_gambler_name(999) == '999'
+
+    # 导入名册 之后分配的 id 从导入的最大 id 之后开始
+    assert model.import_gambler_registry([{'_id': g1.id, 'name': g1.name}, {'_id': 10, 'name': '老套'}]) == 1
+    assert model.find_gambler_name(10) == '老套'
+    assert model.find_gambler_id('新人') == 11
+
+    # 与已有记录冲突
+    with pytest.raises(ValueError):
+        model.import_gambler_registry([{'_id': 10, 'name': '老大'}])
+    with pytest.raises(ValueError):
+        model.import_gambler_registry([{'_id': 12, 'name': '老套'}])
+
+
+def test_model_migrate_gambler_ids(match1, match2):
+    # 旧格式 以名字引用 gambler
+    db.gambler.insert_many([{'name': 'g1'}, {'name': 'g2'}])
+    db.auction.insert_one({'team': '水宫', 'gambler': 'g2', 'price': 12})
+    db.match.update_one({'id': match1.id}, {'$set': {'a.gamblers': ['g1', 'g2'], 'b.gamblers': ['g3']}})
+    version = model.find_version('match')
+
+    assert model.migrate_gambler_ids(db) == dict(gambler=2, auction=1, match=1)
+    ids = {name: model.find_gambler_id(name, create=False) for name in ('g1', 'g2', 'g3')}
+    assert sorted(ids.values()) == [1, 2, 3]
+    assert [d['id'] for d in db.gambler.find()] == [ids['g1'], ids['g2']]
+    assert model.find_gamblers() == ['g1', 'g2']
+    assert model.find_team_owner('水宫') == 'g2'
+    match = model.find_match_by_id(match1.id)
+    assert (match.a.gamblers, match.b.gamblers) == ([ids['g1'], ids['g2']], [ids['g3']])
+    assert model.find_version('match') == version + 1
+
+    # 可重复执行
+    assert model.migrate_gambler_ids(db) == dict(gambler=0, auction=0, match=0)
+    assert model.find_match_by_id(match1.id) == match
+
+
+def test_model_ensure_indexes(match1):
+    model.ensure_indexes()
+    assert db.match.index_information()['id_1']['unique']
+    assert logindb.user.index_information()['openid_1']['unique']
+
+    # match.id 唯一索引阻止重复插入
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        db.match.insert_one(match1._asdict())
+    assert model.insert_match('硬糙', match1.match_time, '平手', '水宫', '利浦', 1, 1, None, None) == match1
+    assert len(list(db.match.find({'id': match1.id}))) == 1
+
+
+def test_model_ensure_indexes_failure(match1):
+    # match.id 已有重复记录 唯一索引无法创建 其余索引照常创建
+    db.match.insert_one(match1._asdict())
+    with pytest.raises(pymongo.errors.OperationFailure, match='1 indexes not created'):
+        model.ensure_indexes()
+    assert 'id_1' not in db.match.index_information()
+    assert db.standings.index_information()['id_1']['unique']
+    assert logindb.user.index_information()['openid_1']['unique']
+
+    r = app.test_cli_runner().invoke(args=['ensure_indexes', '--explain', 'false'])
+    assert r.exit_code == 1 and 'indexes not created' in r.output
 
 
 def test_model_update_match_score(match1):
@@ -232,25 +389,44 @@ def test_model_update_match_gamblers(match1, g1):
     with freeze_time('2018-03-31 03:59:59'):
         model.update_match_gamblers(match1.id, 'a', g1)
         match_found = model.find_match_by_id(match1.id)
-        assert 'g1' not in match_found.a['gamblers'] and 'g1' not in match_found.b['gamblers']
+        assert g1.id not in match_found.a['gamblers'] and g1.id not in match_found.b['gamblers']
 
     # 盘口已定 开赛前 第一次投注
     with freeze_time('2018-03-31 04:00:01'):
         model.update_match_gamblers(match1.id, 'a', g1)
         match_found = model.find_match_by_id(match1.id)
-        assert 'g1' in match_found.a['gamblers'] and 'g1' not in match_found.b['gamblers']
+        assert g1.id in match_found.a['gamblers'] and g1.id not in match_found.b['gamblers']
 
     # 盘口已定 开赛前 改注
     with freeze_time('2018-03-31 04:00:03'):
         model.update_match_gamblers(match1.id, 'b', g1)
         match_found = model.find_match_by_id(match1.id)
-        assert 'g1' not in match_found.a['gamblers'] and 'g1' in match_found.b['gamblers']
+        assert g1.id not in match_found.a['gamblers'] and g1.id in match_found.b['gamblers']
 
     # 开赛后 投注结果不再改变
     with freeze_time('2018-03-31 11:30:01'):
         model.update_match_gamblers(match1.id, 'a', g1)
         match_found = model.find_match_by_id(match1.id)
-        assert 'g1' not in match_found.a['gamblers'] and 'g1' in match_found.b['gamblers']
+        assert g1.id not in match_found.a['gamblers'] and g1.id in match_found.b['gamblers']
+
+
+@pytest.mark.parametrize('utcnow', [
+    '2018-03-30 03:59:59', '2018-03-30 04:00:00', '2018-03-31 03:59:59', '2018-03-31 04:00:00',
+    '2018-03-31 04:00:01', '2018-03-31 11:30:00', '2018-03-31 11:30:01', '2018-04-01 04:00:00',
+])
+def test_model_update_match_gamblers_window(match1, g1, utcnow):
+    # 投注时间窗口与 Match.can_bet() 一致
+    with freeze_time(utcnow):
+        assert model.update_match_gamblers(match1.id, 'a', g1) == match1.can_bet()
+
+
+def test_model_update_match_gamblers_result(match1, g1):
+    assert model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    # 重复投注同一方同样视为成功
+    assert model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    assert not model.update_match_gamblers('non-existent', 'a', g1, cutoff_check=False)
+    with pytest.raises(ValueError):
+        model.update_match_gamblers(match1.id, 'c', g1, cutoff_check=False)
 
 
 def test_model_update_match_gamblers_signup(match1, u0):
@@ -278,11 +454,262 @@ def test_model_update_match_time(match1):
     assert model.find_match_by_id(match_id=next_id).match_time == next_time
 
 
+class FakeResponse:
+
+    def __init__(self, data):
+        self.status_code = 200
+        self.data = data
+
+    def json(self):
+        return dict(data=self.data)
+
+
+class FakeSession:
+
+    def __init__(self, events):
+        self.events = events
+        self.requests = []
+
+    def get(self, url, timeout):
+        assert timeout == config.FETCH_TIMEOUT
+        self.requests.append(None)
+        return FakeResponse([dict(ev_id=1, markets=[dict(name='让球盘', hcap_disp='-0.5/1')])])
+
+    def post(self, url, timeout, json=None):
+        assert timeout == config.FETCH_TIMEOUT
+        date = (json or {}).get('date')
+        self.requests.append(date)
+        return FakeResponse(dict(list=self.events.get(date, [])))
+
+
+def test_match_getter_get_match_data(monkeypatch):
+    def event(evid, start_date, team_a, team_b, **kwargs):
+        return dict(evId=evid, startDate=start_date, hometeamNameZh=team_a, awayteamNameZh=team_b,
+                    uqTournament=dict(nameZh='硬糙'), **kwargs)
+
+    session = FakeSession({
+        '2018-03-30': [event(0, '2018-03-30 19:30', '水宫', '利浦', hcap=dict(ftHandicap='+1'), score=dict(ft='2:4'))],
+        '2018-03-31': [event(1, '2018-03-31 22:10', '纽尔联', '哈尔德')],
+        None: [event(1, '2018-03-31 22:10', '纽尔联', '哈尔德'), event(2, '2018-04-01 20:30', '利浦', '白顿')],
+    })
+    monkeypatch.setattr(match_getter, '_session', session)
+
+    matches = match_getter.get_match_data('硬糙', current_date=datetime.datetime(2018, 3, 31, 12))
+    # 共享 session 发出全部请求
+    assert sorted(session.requests, key=str) == ['2018-03-30', '2018-03-31', None, None]
+    assert matches == [
+        ('硬糙', datetime.datetime(2018, 3, 30, 19, 30), '受一球', '水宫', '利浦', 0, 0, '2', '4'),
+        ('硬糙', datetime.datetime(2018, 3, 31, 22, 10), '半球/一球', '纽尔联', '哈尔德', 0, 0, None, None),
+    ]
+
+
+@pytest.fixture
+def acw_adapter(monkeypatch, tmp_path):
+    # 每个测试从冷启动开始
+    for attr in ('COOKIE_VALUE', 'COOKIE_SOLVED_AT', 'COOKIE_LIFETIME'):
+        monkeypatch.setattr(match_getter.AcwScV2Adapter, attr, None)
+    return lambda: match_getter.AcwScV2Adapter(cookie_cache=str(tmp_path / 'acw.json'))
+
+
+def test_match_getter_acw_cookie_cache(monkeypatch, acw_adapter):
+    challenge = FakeResponse(None)
+    challenge.text = 'var arg1="0123";acw_sc__v2'
+    ok = FakeResponse(None)
+    ok.text = '{}'
+    responses = [challenge, ok, challenge, ok, ok]
+    monkeypatch.setattr(match_getter.HTTPAdapter, 'send', lambda self, request, **kwargs: responses.pop(0))
+    monkeypatch.setattr(match_getter.AcwScV2Adapter, '_solve', lambda self, html: f'solved-{len(responses)}')
+    request = requests.Request('GET', 'https://example.com/').prepare()
+
+    # 冷启动 求解后写入缓存文件
+    with freeze_time('2018-03-31 04:00:00'):
+        assert acw_adapter().send(request) is ok
+    assert request.headers['Cookie'] == 'acw_sc__v2=solved-4'
+
+    # 再次被 challenge 时记录 cookie 有效时长
+    with freeze_time('2018-03-31 05:00:00'):
+        assert acw_adapter().send(request) is ok
+    assert request.headers['Cookie'] == 'acw_sc__v2=solved-2'
+    assert match_getter.AcwScV2Adapter.COOKIE_LIFETIME == 3600
+
+    # 新进程从缓存文件读取 cookie 不再求解
+    monkeypatch.setattr(match_getter.AcwScV2Adapter, 'COOKIE_VALUE', None)
+    with freeze_time('2018-03-31 05:59:59'):
+        assert acw_adapter().send(request) is ok
+    assert request.headers['Cookie'] == 'acw_sc__v2=solved-2'
+
+    # 超过有效时长的 cookie 不再读取
+    monkeypatch.setattr(match_getter.AcwScV2Adapter, 'COOKIE_VALUE', None)
+    with freeze_time('2018-03-31 06:00:00'):
+        acw_adapter()
+    assert match_getter.AcwScV2Adapter.COOKIE_VALUE is None
+
+
+def test_match_getter_acw_cookie_cache_file(tmp_path, acw_adapter):
+    # 默认不缓存
+    assert config.ACW_COOKIE_CACHE == ''
+
+    # 他人预先放置的 symlink 不会被跟随
+    victim = tmp_path / 'victim'
+    victim.write_text('untouched')
+    (tmp_path / f'acw.json.{os.getpid()}.tmp').symlink_to(victim)
+    match_getter.AcwScV2Adapter.COOKIE_VALUE, match_getter.AcwScV2Adapter.COOKIE_SOLVED_AT = 'cookie', 1
+    acw_adapter()._save_cookie()
+    assert victim.read_text() == 'untouched'
+    assert json.loads((tmp_path / 'acw.json').read_text())['value'] == 'cookie'
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(['victim', 'acw.json', f'acw.json.{os.getpid()}.tmp'])
+
+
+@pytest.mark.parametrize('name', sorted(bench.load_acw_corpus()))
+def test_acw_solver_corpus(name):
+    html, cookie = bench.load_acw_corpus()[name]
+    assert acw_solver.solve(html) == cookie
+    assert match_getter.AcwScV2Adapter()._solve(html) == cookie
+
+
+def test_acw_solver_rc4():
+    assert acw_solver.rc4(b'Plaintext', b'Key').hex() == 'bbf316e8d940af0ad3'
+    assert acw_solver.rc4(acw_solver.rc4(b'pedia', b'Wiki'), b'Wiki') == b'pedia'
+    assert acw_solver.rc4(b'', b'Key') == b''
+
+
+def test_acw_solver_errors():
+    html, _ = next(iter(bench.load_acw_corpus().values()))
+    with pytest.raises(ValueError, match='arg1 not found'):
+        acw_solver.solve(html.replace('var arg1', 'var arg2'))
+    with pytest.raises(ValueError, match='shuffles array not found'):
+        acw_solver.solve(re.sub(r'\[(0x[0-9a-f]+,){39}0x[0-9a-f]+\]', '[]', html))
+    with pytest.raises(ValueError, match='not found'):
+        acw_solver.solve('<html>no challenge</html>')
+
+
+def test_bench_run_solver():
+    result = bench.run_solver(repeat=1, rc4_bytes=16)
+    assert result['params'] == dict(pages=len(bench.load_acw_corpus()), rc4_bytes=16, repeat=1)
+    assert set(result['results']) == {'solve_corpus', 'rc4'}
+
+
+def test_match_getter_populate_and_update(monkeypatch, match1, g1):
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    match3_time = datetime.datetime(2018, 4, 1, 20, 30)
+    fetched = [
+        # 已存在比赛 更新盘口及比分
+        ('硬糙', match1.match_time, '半球', '水宫', '利浦', 0, 0, '3', '0'),
+        # 新比赛
+        ('硬糙', match3_time, '平手', '水宫', '纽尔联', 0, 0, None, None),
+        # 尚早比赛
+        ('硬糙', datetime.datetime(2018, 4, 9, 20, 30), '平手', '利浦', '纽尔联', 0, 0, None, None),
+    ]
+    monkeypatch.setattr(match_getter, 'get_match_data', lambda league, current_date: fetched)
+
+    with freeze_time('2018-03-31 03:59:59'):
+        changeset = match_getter.populate_and_update('硬糙', [(datetime.datetime(2018, 4, 1), 4)], k=2)
+    assert changeset == match_getter.Changeset(
+        new=[model._generate_match_id(match3_time, '水宫', '纽尔联')],
+        handicaps=[(match1.id, '受一球', '半球')],
+        scores=[(match1.id, (2, 4), (3, 0))],
+    )
+
+    assert [m.id for m in model.find_matches()] == [match1.id, model._generate_match_id(match3_time, '水宫', '纽尔联')]
+    match_found = model.find_match_by_id(match1.id)
+    assert match_found.handicap_display == '半球' and match_found.handicap == (0.5, 0.5)
+    assert match_found.a['score'] == 3 and match_found.b['score'] == 0
+    assert match_found.a['gamblers'] == [g1.id]
+    match_found = model.find_matches()[-1]
+    assert match_found.weight == 2 and not match_found.has_score()
+    # 比分变化后积分榜随之更新
+    assert _series_asdict(model.find_standings()) == {'g1': OrderedDict([(match1.id, 0.0)])}
+
+    # 没有变化时不写入
+    versions = model.find_version('match'), model.find_version('standings')
+    with freeze_time('2018-03-31 03:59:59'):
+        changeset = match_getter.populate_and_update('硬糙', [(datetime.datetime(2018, 4, 1), 4)], k=2)
+    assert changeset == match_getter.Changeset(new=[], handicaps=[], scores=[])
+    assert (model.find_version('match'), model.find_version('standings')) == versions
+
+    # 盘口截止后不再更新盘口
+    fetched[0] = ('硬糙', match1.match_time, '一球', '水宫', '利浦', 0, 0, '3', '0')
+    with freeze_time('2018-03-31 04:00:01'):
+        changeset = match_getter.populate_and_update('硬糙', [], k=2)
+    assert changeset.handicaps == []
+    assert model.find_match_by_id(match1.id).handicap_display == '半球'
+
+
 ##########
 # calculation tests
 ##########
 
 
+@pytest.mark.parametrize('now,score,expected', [
+    # 盘口截止（当天 12:00）前 HANDICAP_WINDOW 之外 等到窗口开始
+    (datetime.datetime(2018, 3, 31, 11, 20), None, 25 * 60),
+    # 盘口截止前 HANDICAP_WINDOW 内
+    (datetime.datetime(2018, 3, 31, 11, 50), None, match_getter.POLL_BUSY),
+    # 盘口已截止 等到开赛
+    (datetime.datetime(2018, 3, 31, 19, 0), None, 30 * 60),
+    # 比赛进行中 尚无比分
+    (datetime.datetime(2018, 3, 31, 20, 0), None, match_getter.POLL_LIVE),
+    # 已有比分
+    (datetime.datetime(2018, 3, 31, 21, 30), (2, 1), match_getter.POLL_IDLE),
+    # 开赛后 SCORE_WINDOW 仍无比分
+    (datetime.datetime(2018, 4, 1, 2, 0), None, match_getter.POLL_IDLE),
+    # 距盘口截止超过 POLL_IDLE
+    (datetime.datetime(2018, 3, 30, 11, 30), None, match_getter.POLL_IDLE),
+])
+def test_match_getter_next_poll_delay(now, score, expected):
+    match = model.Match('硬糙', datetime.datetime(2018, 3, 31, 19, 30), '受一球', '水宫', '利浦', 2.08, 1.78, *(score or (None, None)), owners={})
+    assert match_getter.next_poll_delay([match], now) == expected
+    assert match_getter.next_poll_delay([], now) == match_getter.POLL_IDLE
+
+
+def test_match_getter_run_daemon(monkeypatch, match1):
+    polls = []
+
+    def populate_and_update(league, weight_schedule, k):
+        polls.append(league)
+        if len(polls) == 2:
+            raise IOError('upstream unavailable')
+
+    monkeypatch.setattr(match_getter, 'populate_and_update', populate_and_update)
+    delays = []
+    # 单次抓取失败不退出
+    match_getter.run_daemon('硬糙', [], max_polls=3, sleep=delays.append)
+    assert polls == ['硬糙'] * 3
+    assert delays == [match_getter.POLL_IDLE] * 2
+
+    # 读取比赛失败（如数据库切换主节点）同样不退出 以固定间隔重试
+    def find_matches(projection=None):
+        if len(polls) == 4:
+            raise pymongo.errors.AutoReconnect('failover')
+        return []
+
+    monkeypatch.setattr(match_getter, 'find_matches', find_matches)
+    delays.clear()
+    match_getter.run_daemon('硬糙', [], max_polls=3, sleep=delays.append)
+    assert polls == ['硬糙'] * 6
+    assert delays == [match_getter.POLL_RETRY, match_getter.POLL_IDLE]
+
+
+def test_match_getter_run_daemon_timeout(monkeypatch):
+    # 上游无响应 每个请求都在 FETCH_TIMEOUT 后失败
+    timeouts = []
+
+    def send(self, request, **kwargs):
+        timeouts.append(kwargs['timeout'])
+        raise requests.exceptions.ReadTimeout('stalled')
+
+    monkeypatch.setattr(match_getter, '_session', None)
+    monkeypatch.setattr(match_getter.HTTPAdapter, 'send', send)
+    monkeypatch.setattr(match_getter, 'find_matches', lambda projection=None: [])
+    delays = []
+    # 抓取失败计为一次失败的轮询 之后继续轮询
+    match_getter.run_daemon('硬糙', [], max_polls=2, sleep=delays.append)
+    assert delays == [match_getter.POLL_IDLE]
+    # 2 次轮询 × 4 个请求 × 10 次重试
+    assert len(timeouts) == 2 * 4 * 10
+    assert set(timeouts) == {config.FETCH_TIMEOUT}
+
+
 @pytest.mark.parametrize('choice_a,choice_b,no_choice,handicap,score_a,score_b,expected', [
     (['g1', 'g2'], ['g3', 'g4'],      [],       '球半', '3', '1', {'g1': 2, 'g2': 2, 'g3': -2, 'g4': -2}),  # 有胜负
     (['g1', 'g2'], ['g3', 'g4'],      [],       '平手', '0', '0', {'g1': 0,  'g2': 0,  'g3': 0, 'g4': 0}),  # 平局
@@ -318,7 +745,7 @@ def test_Match_update_profit_and_loss_no_auction(choice_a, choice_b, no_choice,
     result = match.update_profit_and_loss_result(required_gamblers=model.find_gamblers())
 
     for k, v in expected.items():
-        assert result.get(k) == v
+        assert result.get(model.find_gambler_id(k)) == v
 
 
 @pytest.mark.parametrize('choice_a,choice_b,no_choice,handicap,score_a,score_b,expected', [
@@ -356,7 +783,7 @@ def test_Match_update_profit_and_loss_with_auction(choice_a, choice_b, no_choice
     result = match.update_profit_and_loss_result(required_gamblers=model.find_gamblers())
 
     for k, v in expected.items():
-        assert result.get(k) == v
+        assert result.get(model.find_gambler_id(k)) == v
 
 
 @pytest.mark.parametrize('choice_a,choice_b,no_choice,handicap,score_a,score_b,expected', [
@@ -394,7 +821,7 @@ def test_Match_update_profit_and_loss_with_self_auction(choice_a, choice_b, no_c
     result = match.update_profit_and_loss_result(required_gamblers=model.find_gamblers())
 
     for k, v in expected.items():
-        assert result.get(k) == v
+        assert result.get(model.find_gambler_id(k)) == v
 
 
 def test_model_generate_series(g1, g2, g3, g4, match1, match2):
@@ -408,6 +835,446 @@ def test_model_generate_series(g1, g2, g3, g4, match1, match2):
     assert results == expected
 
 
+def test_model_settle_matches(g1, g2, match1, match2):
+    match3 = model.insert_match('硬糙', datetime.datetime(2018, 4, 1, 20, 30), '平手', '水宫', '纽尔联', 1.01, 1.39, None, None)
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+
+    results = model.settle_matches(model.find_matches(reverse=True), model.find_gamblers())
+    # 按比赛时间排序 未有比分的比赛不结算
+    assert list(results.keys()) == [match1.id, match2.id]
+    assert match3.id not in results
+    assert results[match1.id] == {g1.id: -2.0, g2.id: -2.0}
+
+
+def _series_asdict(many_series):
+    return {series.gambler: series.points for series in many_series if series.points}
+
+
+@pytest.mark.parametrize('lock_ttl', [model.STANDINGS_LOCK_TTL, -model.STANDINGS_LOCK_TTL])
+def test_model_refresh_standings_concurrent(monkeypatch, g1, g2, auction2, match1, match2, lock_ttl):
+    # standings.id 唯一索引
+    model.ensure_indexes()
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    model.update_match_gamblers(match2.id, 'b', g2, cutoff_check=False)
+
+    settle = settlement.settle
+    active, overlaps = [], []
+
+    def slow_settle(*args):
+        active.append(None)
+        overlaps.append(len(active))
+        time.sleep(0.05)
+        try:
+            return settle(*args)
+        finally:
+            active.pop()
+
+    monkeypatch.setattr(settlement, 'settle', slow_settle)
+    # 锁已过期时各次重算互相重叠
+    monkeypatch.setattr(model, 'STANDINGS_LOCK_TTL', lock_ttl)
+    errors = []
+
+    def refresh(since):
+        with app.app_context():
+            try:
+                model.refresh_standings(since)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=refresh, args=(since,))
+               for since in (None, match1.match_time, None, match2.match_time)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert (max(overlaps) == 1) == (lock_ttl > datetime.timedelta(0))
+    assert _series_asdict(model.find_standings()) == _series_asdict(model.generate_series())
+    assert db.standings.count() == 2
+    assert not db.meta.find_one({'_id': 'standings_lock'})
+
+
+def test_model_standings(g1, g2, g3, auction2, match1, match2):
+    def check():
+        assert _series_asdict(model.find_standings()) == _series_asdict(model.generate_series())
+
+    check()
+    # bet
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    model.update_match_gamblers(match2.id, 'b', g2, cutoff_check=False)
+    check()
+    # score
+    model.update_match_score(match1.id, '3', '1')
+    check()
+    # weight
+    model.update_match_weight(match2.id, 8)
+    check()
+    # auction
+    model.insert_auction(team='纽尔联', gambler=g2, price=1)
+    check()
+    # new gambler
+    model.update_match_gamblers(match2.id, 'a', model.Gambler('g5'), cutoff_check=False)
+    check()
+    # match time
+    model.update_match_time(match1.id, match2.match_time + datetime.timedelta(hours=1))
+    check()
+    # user name
+    model.update_user_name(current=g3.name, new='巨型钻')
+    check()
+
+    standings = model.find_standings()
+    assert [s.gambler for s in standings] == ['g1', 'g2', '巨型钻', 'g5']
+
+
+def test_model_all_time_standings(g1, g2, g3, match1, match2):
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    model.update_match_gamblers(match2.id, 'b', g2, cutoff_check=False)
+    model.update_match_score(match1.id, '3', '1')
+    model.update_match_score(match2.id, '0', '0')
+
+    standings = model.generate_all_time_standings()
+    final = {s.gambler: list(s.points.values())[-1] for s in model.generate_series()}
+    assert {s.gambler: s.total for s in standings} == final
+    assert [s.total for s in standings] == sorted(final.values(), reverse=True)
+    assert all(list(s.points) == [config.DEFAULT_TOURNAMENT.dbname] for s in standings)
+    # 读取积分榜与重新结算的结果一致
+    assert model.generate_all_time_standings(resettle=True, parallel=False) == standings
+
+    # 新报名的 gambler 未投注的历史比赛均扣分
+    model.insert_gambler('g9')
+    assert model.generate_all_time_standings() == model.generate_all_time_standings(resettle=True, parallel=False)
+
+
+def test_model_all_time_standings_empty(g1):
+    # 尚无已结算比赛
+    assert model.generate_all_time_standings() == [model.AllTimeStanding('g1', 0, {config.DEFAULT_TOURNAMENT.dbname: 0})]
+    assert model.generate_all_time_standings(resettle=True, parallel=False) == model.generate_all_time_standings()
+
+
+@pytest.mark.parametrize('tournament', ['worldcup2018', 'championsleague20182019'])
+def test_model_all_time_standings_parallel(tournament):
+    load_history(tournament)
+    model.refresh_standings()
+    # 进程池中的 spawn 子进程自行连接数据库 结果与读取积分榜及串行结算一致
+    standings = model.generate_all_time_standings(resettle=True, parallel=True)
+    assert standings == model.generate_all_time_standings(resettle=True, parallel=False)
+    assert standings == model.generate_all_time_standings()
+
+
+def test_app_api_board(g1, g2, match1):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = 'openid-g1'
+
+    r = client.get('/api/board')
+    assert r.status_code == 200
+    assert [d['label'] for d in r.json['datasets']] == ['g1', 'g2']
+    etag = r.headers['ETag']
+
+    # 积分榜未改写
+    r = client.get('/api/board', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+
+    # 已有比分的比赛投注后积分榜改写
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    r = client.get('/api/board', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+    assert r.json['labels'] == ['', '水宫 vs 利浦']
+
+
+def test_model_poll_matches(match1, match2, g1):
+    events = model._poll_matches(interval=0, deadline=float('inf'))
+    assert next(events) == []
+    assert next(events) == []
+
+    model.update_match_gamblers(match1.id, 'b', g1, cutoff_check=False)
+    model.update_match_weight(match2.id, 8)
+    assert next(events) == [
+        dict(id=match1.id, weight=2, handicap_display='受一球',
+             a=dict(gamblers=[], score=2), b=dict(gamblers=['g1'], score=4)),
+        dict(id=match2.id, weight=8, handicap_display='半球/一球',
+             a=dict(gamblers=[], score=2), b=dict(gamblers=[], score=1)),
+    ]
+    assert next(events) == []
+
+
+def test_model_poll_matches_shared(monkeypatch, match1, match2, g1):
+    reads = []
+    find = model._match_event
+    monkeypatch.setattr(model, '_match_event', lambda m: reads.append(m['id']) or find(m))
+
+    # 版本号未变化时不读取比赛 多个连接共用同一版本的比赛
+    connections = [model._poll_matches(interval=0, deadline=float('inf')) for _ in range(3)]
+    for _ in range(2):
+        assert [next(events) for events in connections] == [[], [], []]
+    assert reads == [match1.id, match2.id]
+
+    model.update_match_weight(match2.id, 8)
+    assert [[e['id'] for e in next(events)] for events in connections] == [[match2.id]] * 3
+    assert reads == [match1.id, match2.id] * 2
+
+
+def test_app_events(monkeypatch, g1u, match1):
+    monkeypatch.setattr(model, 'watch_matches', lambda interval, timeout: iter([[], [dict(id=match1.id)]]))
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = 'openid-g1'
+
+    r = client.get('/events')
+    assert r.mimetype == 'text/event-stream'
+    assert r.get_data(as_text=True) == f': keepalive\n\nevent: match\ndata: {{"id": "{match1.id}"}}\n\n'
+
+
+def test_cli_import_collection(tmp_path, match1, match2):
+    archive = tmp_path / 'match.json'
+    docs = list(db.match.find())
+    docs[0]['weight'] = 8
+    docs.append({k: v for k, v in docs[1].items() if k != '_id'} | dict(id='201804011930-水宫-纽尔联'))
+    archive.write_text(''.join(bson.json_util.dumps(d) + '\n' for d in docs))
+
+    runner = app.test_cli_runner()
+    r = runner.invoke(args=['import_collection', db.name, 'match', str(archive), '--upsert', 'true', '--batch-size', '2'])
+    assert r.exit_code == 0, r.output
+    assert '3 records, 1 inserted, 1 modified, 0 skipped' in r.output
+    assert model.find_match_by_id(match1.id).weight == 8
+    assert len(model.find_matches()) == 3
+
+    r = runner.invoke(args=['import_collection', db.name, 'match', str(archive), '--batch-size', '2'])
+    assert r.exit_code == 0, r.output
+    assert '3 records, 3 inserted, 0 modified' in r.output
+    assert len(model.find_matches()) == 3
+    # drop 后重建索引
+    assert db.match.index_information()['id_1']['unique']
+
+    # 缺少 upsert key 的记录被跳过并报告
+    docs[0].pop('id')
+    archive.write_text(''.join(bson.json_util.dumps(d) + '\n' for d in docs))
+    r = runner.invoke(args=['import_collection', db.name, 'match', str(archive), '--upsert', 'true'])
+    assert r.exit_code == 1
+    assert 'record #1 has no id, skipped' in r.output
+    assert '3 records, 0 inserted, 0 modified, 1 skipped' in r.output
+    assert len(model.find_matches()) == 3
+
+
+def test_cli_migrate_gambler_ids(tmp_path, match1):
+    db.match.update_one({'id': match1.id}, {'$set': {'a.gamblers': ['g2', 'g1']}})
+    docs = dict(
+        gambler=[{'_id': {'$oid': '5b0000000000000000000001'}, 'name': 'g1'}],
+        auction=[{'_id': {'$oid': '5b0000000000000000000002'}, 'team': '水宫', 'gambler': 'g1', 'price': 12}],
+        match=[{'id': match1.id, 'a': {'gamblers': ['g2', 'g1']}, 'b': {'gamblers': []}}],
+    )
+    (tmp_path / db.name).mkdir()
+    for co, lines in docs.items():
+        (tmp_path / db.name / f'{co}.json').write_text(''.join(json.dumps(d, ensure_ascii=False) + '\n' for d in lines))
+    # 归档中已有的名册 其中的 id 优先使用
+    (tmp_path / config.MONGO_LOGINDB).mkdir()
+    (tmp_path / config.MONGO_LOGINDB / 'gambler.json').write_text('{"_id":7,"name":"g2"}\n')
+
+    r = app.test_cli_runner().invoke(args=['migrate_gambler_ids', db.name, '--history', str(tmp_path)])
+    assert r.exit_code == 0, r.output
+    assert model.find_gambler_id('g2', create=False) == 7
+    assert model.find_match_by_id(match1.id).a.gamblers == [7, 8]
+
+    # 归档与数据库使用相同的 id 其余字段原样保留
+    def read(path):
+        return [json.loads(line) for line in path.read_text().splitlines()]
+
+    assert read(tmp_path / db.name / 'gambler.json') == [{'_id': {'$oid': '5b0000000000000000000001'}, 'id': 8}]
+    assert read(tmp_path / db.name / 'auction.json')[0]['gambler'] == 8
+    assert read(tmp_path / db.name / 'match.json')[0]['a'] == {'gamblers': [7, 8]}
+    assert read(tmp_path / config.MONGO_LOGINDB / 'gambler.json') == [{'_id': 7, 'name': 'g2'}, {'_id': 8, 'name': 'g1'}]
+
+
+def test_cli_bench():
+    # 与旧版模拟数据同名的真实 gambler
+    g000 = model.find_gambler_id('g000')
+    r = app.test_cli_runner().invoke(args=['bench', '--gamblers', '3', '--matches', '8', '--repeat', '2'])
+    assert r.exit_code == 0, r.output
+    result = json.loads(r.output)
+    assert result['params'] == dict(gamblers=3, matches=8, repeat=2, seed=0)
+    assert set(result['results']) == {
+        'find_matches', 'generate_series', 'find_standings', 'update_match_gamblers', 'generate_handicap_pair',
+        'view /', 'view /board', 'view /api/board', 'view /rule',
+    }
+    # 模拟数据已删除
+    assert 'bench' not in [t.dbname for t in config.TOURNAMENTS]
+    assert not logindb.user.find_one({'openid': {'$regex': '^bench-openid-'}})
+    assert not logindb.gambler.find_one({'name': {'$regex': '^__bench-'}})
+    assert logindb.gambler.find_one({'_id': g000}) == {'_id': g000, 'name': 'g000'}
+
+
+def test_querystats_listener():
+    listener = querystats.QueryListener()
+    # 不在统计中时忽略
+    listener.started(pymongo.monitoring.CommandStartedEvent({'find': 'match'}, 'veryhard', 1, ('localhost', 27017), 1))
+
+    with querystats.track() as stats:
+        for request_id, command, micros in [(2, {'find': 'match'}, 1500), (3, {'update': 'gambler'}, 500)]:
+            listener.started(pymongo.monitoring.CommandStartedEvent(command, 'veryhard', request_id, ('localhost', 27017), 1))
+            listener.succeeded(pymongo.monitoring.CommandSucceededEvent(
+                datetime.timedelta(microseconds=micros), {'ok': 1}, next(iter(command)), request_id, ('localhost', 27017), 1))
+    assert stats._asdict() == dict(count=2, total_ms=2.0, slowest='find veryhard.match', slowest_ms=1.5)
+    assert stats.server_timing() == 'db;desc="2 queries";dur=2.000, db-slowest;desc="find veryhard.match";dur=1.500'
+    assert querystats.current() is None
+
+
+def _query_count(response) -> int:
+    return int(re.match(r'db;desc="(\d+) queries"', response.headers['Server-Timing']).group(1))
+
+
+@pytest.mark.parametrize('path', ['/', '/board', '/api/board', '/rule'])
+def test_app_query_count(path, g1, g2, auction2, match1):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = 'openid-g1'
+
+    # 查询次数与比赛数量无关 第一次请求用于预热登录用户缓存
+    client.get(path)
+    count = _query_count(client.get(path))
+    model.insert_match('硬糙', datetime.datetime(2018, 4, 1, 19, 30), '平手', '纽尔联', '利浦', 2.0, 1.8, 1, 1)
+    model.insert_match('硬糙', datetime.datetime(2018, 4, 2, 19, 30), '平手', '哈尔德', '水宫', 2.0, 1.8, None, None)
+    assert _query_count(client.get(path)) == count <= config.QUERY_BUDGET
+
+
+def test_metrics_render():
+    # 模拟两个进程的数据
+    snapshots = []
+    for values in ([0.0078125, 0.5], [2]):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram(registry, 'h_seconds', 'H.', ('stage',), buckets=(0.01, 1))
+        counter = metrics.Counter(registry, 'c_total', 'C.', ('result',))
+        for value in values:
+            histogram.observe(value, stage='download')
+            counter.inc(result='ok')
+        snapshots.append(json.loads(json.dumps(registry.snapshot())))
+    assert metrics.render(metrics.merge(snapshots)) == (
+        '# HELP c_total C.\n'
+        '# TYPE c_total counter\n'
+        'c_total{result="ok"} 3\n'
+        '# HELP h_seconds H.\n'
+        '# TYPE h_seconds histogram\n'
+        'h_seconds_bucket{stage="download",le="0.01"} 1\n'
+        'h_seconds_bucket{stage="download",le="1"} 2\n'
+        'h_seconds_bucket{stage="download",le="+Inf"} 3\n'
+        'h_seconds_sum{stage="download"} 2.5078125\n'
+        'h_seconds_count{stage="download"} 3\n'
+    )
+
+    with pytest.raises(ValueError):
+        counter.inc(stage='download')
+
+
+def test_metrics_retire(tmp_path):
+    def registry_with(value):
+        registry = metrics.Registry(directory=str(tmp_path))
+        metrics.Counter(registry, 'c_total', 'C.').inc(value)
+        return registry
+
+    def total():
+        return metrics.merge([registry_with(0).collect()])['c_total']['samples'][0][1]
+
+    # 已退出进程留下的文件
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    metrics._dump(registry_with(2).snapshot(), str(tmp_path / f'metrics-{process.pid}.json'))
+    assert total() == 2
+    assert not (tmp_path / f'metrics-{process.pid}.json').exists()
+    assert total() == 2
+
+    # pid 被复用 新进程第一次写入前合并旧文件
+    metrics._dump(registry_with(3).snapshot(), str(tmp_path / f'metrics-{os.getpid()}.json'))
+    registry = registry_with(1)
+    assert metrics.merge([registry.collect()])['c_total']['samples'][0][1] == 6
+
+    # 正常退出的进程合并入 retired.json
+    registry.close()
+    assert sorted(p.name for p in tmp_path.glob('*.json')) == ['retired.json']
+    assert total() == 6
+
+
+def test_app_metrics(g1u, match1):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = 'openid-g1'
+    client.post('/', data={'match-id': match1.id, 'bet-choice': 'a'})
+
+    r = client.get('/metrics')
+    assert r.mimetype == 'text/plain'
+    text = r.get_data(as_text=True)
+    assert 'worldcup_bets_total{result="rejected"}' in text
+    assert 'worldcup_request_duration_seconds_count{endpoint="index",method="POST",status="409"}' in text
+    assert 'worldcup_settlement_duration_seconds_count{function="refresh_standings"}' in text
+
+
+def test_app_match_cards(monkeypatch, g1u, match1, match2):
+    monkeypatch.setitem(app.config, 'MAX_MATCH_DISPLAY', 1)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = 'openid-g1'
+
+    def match_ids(html):
+        return re.findall(r'data-match-id="(\d[^"]*)"', html)
+
+    r = client.get('/')
+    assert match_ids(r.get_data(as_text=True)) == [match2.id]
+    assert 'data-done="false"' in r.get_data(as_text=True)
+    # 以最后一场比赛的 id 取得下一页
+    r = client.get('/matches', query_string={'before': match2.id})
+    assert match_ids(r.get_data(as_text=True)) == [match1.id]
+    r = client.get('/matches', query_string={'before': match1.id})
+    assert match_ids(r.get_data(as_text=True)) == []
+
+    # ajax 投注滚动加载的比赛 只返回该比赛的卡片
+    ajax = {'X-Requested-With': 'XMLHttpRequest'}
+    with freeze_time('2018-03-31 04:00:01'):
+        # session 须在同一时间签发
+        with client.session_transaction() as session:
+            session['openid'] = 'openid-g1'
+        # 浏览可投注的比赛不会为未投注的用户分配 gambler id
+        r = client.get('/')
+        assert 'bet-button' in r.get_data(as_text=True)
+        assert 'disabled="true"' not in r.get_data(as_text=True)
+        assert model.find_gambler_id(g1u.name, create=False) is None
+        assert logindb.gambler.count_documents({}) == 0
+        r = client.post('/', data={'match-id': match1.id, 'bet-choice': 'a'}, headers=ajax)
+        assert r.status_code == 200
+        assert match_ids(r.get_data(as_text=True)) == [match1.id]
+        assert 'disabled="true"' in r.get_data(as_text=True)
+        assert '<html' not in r.get_data(as_text=True)
+        # 非 ajax 时仍返回整个页面
+        r = client.post('/', data={'match-id': match1.id, 'bet-choice': 'a'})
+        assert r.status_code == 200
+        assert match_ids(r.get_data(as_text=True)) == [match2.id]
+
+
+def test_app_bet_rejected(g1u, g1, match1):
+    client = app.test_client()
+    ajax = {'X-Requested-With': 'XMLHttpRequest'}
+
+    # 开赛后投注 ajax 返回 409 及原因 由 .fail() 提示
+    with freeze_time('2018-03-31 11:30:01'):
+        with client.session_transaction() as session:
+            session['openid'] = 'openid-g1'
+        r = client.post('/', data={'match-id': match1.id, 'bet-choice': 'a'}, headers=ajax)
+        assert r.status_code == 409
+        assert r.get_data(as_text=True) == BET_REJECTED
+        # 非 ajax 时在页面中提示
+        r = client.post('/', data={'match-id': match1.id, 'bet-choice': 'a'})
+        assert r.status_code == 409
+        assert BET_REJECTED in r.get_data(as_text=True)
+        # 提示只显示一次
+        assert BET_REJECTED not in client.get('/').get_data(as_text=True)
+
+    with client.session_transaction() as session:
+        session['openid'] = 'openid-g1'
+    r = client.post('/', data={'match-id': 'non-existent', 'bet-choice': 'a'}, headers=ajax)
+    assert r.status_code == 409
+    assert g1.id not in model.find_match_by_id(match1.id).a.gamblers
+
+
 ##########
 # integration tests
 ##########
@@ -415,13 +1282,64 @@ def test_model_generate_series(g1, g2, g3, g4, match1, match2):
 
 def load_history(tournament):
 
-    def _load_json(filename):
-        with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'history', tournament, filename)) as f:
+    def _load_json(dirname, filename):
+        path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'history', dirname, filename)
+        # championsleague20182019 没有拍卖记录
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
             return [bson.json_util.loads(line) for line in f]
 
-    (docs := _load_json('gambler.json')) and db.gambler.insert_many(docs)
-    (docs := _load_json('auction.json')) and db.auction.insert_many(docs)
-    (docs := _load_json('match.json')) and db.match.insert_many(docs)
+    # 各 tournament 共用的 gambler 名册
+    model.import_gambler_registry(_load_json(config.MONGO_LOGINDB, 'gambler.json'))
+    (docs := _load_json(tournament, 'gambler.json')) and db.gambler.insert_many(docs)
+    (docs := _load_json(tournament, 'auction.json')) and db.auction.insert_many(docs)
+    (docs := _load_json(tournament, 'match.json')) and db.match.insert_many(docs)
+
+
+@pytest.mark.parametrize('tournament', ['eurocup2016', 'worldcup2018', 'worldcup2022', 'eurocup2024', 'worldcup2026'])
+def test_history_standings(tournament):
+    load_history(tournament)
+    model.refresh_standings()
+    assert _series_asdict(model.find_standings()) == _series_asdict(model.generate_series())
+
+
+@pytest.mark.parametrize('tournament', [
+    'eurocup2016', '2018-international-friendlies', 'worldcup2018', 'championsleague20182019', 'worldcup2022',
+    'eurocup2024', 'worldcup2026',
+])
+def test_history_settlement(tournament):
+    load_history(tournament)
+    gamblers = model.find_gamblers()
+    matches = model.find_matches()
+
+    # 数组结算与逐场结算结果完全一致
+    expected = model.settle_matches(matches, gamblers)
+    s = settlement.settle(matches, [gambler.id for gambler in gamblers])
+    assert s.match_ids == list(expected.keys())
+    for i, result in enumerate(expected.values()):
+        assert {g: s.results[i, j] for g, j in s.index.items() if g in result} == result
+        assert not s.results[i, [j for g, j in s.index.items() if g not in result]].any()
+
+    # 累计积分与 Series 逐场累加结果完全一致
+    assert [series.__dict__ for series in model.generate_series()] == [
+        model.Series(gambler, expected).__dict__ for gambler in gamblers]
+
+
+# 2018-international-friendlies 由旧版 mongoexport 导出 $date 时区写作 +0000
+@pytest.mark.parametrize('tournament', ['eurocup2016', 'worldcup2018', 'worldcup2022', 'eurocup2024', 'worldcup2026'])
+def test_history_export(tournament, tmp_path):
+    load_history(tournament)
+    runner = app.test_cli_runner()
+    r = runner.invoke(args=['export_tournament', '--out', str(tmp_path)])
+    assert r.exit_code == 0, r.output
+
+    # 导出结果与 history/ 中的归档逐字节一致
+    for collection in cli.EXPORT_COLLECTIONS:
+        with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'history', tournament, f'{collection}.json')) as f:
+            expected = f.read()
+        with open(tmp_path / db.name / f'{collection}.json') as f:
+            assert f.read().rstrip('\n') == expected.rstrip('\n')
 
 
 def test_history_eurocup2016():